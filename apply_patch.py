@@ -0,0 +1,19 @@
+'''
+Created on Oct 18, 2026
+
+@author: Button
+
+Applies a patch written by a run with the 'patch' property set. Run it as
+
+    python apply_patch.py [patchfile] [raw directory]
+
+Both default to the 'patch' and 'target' properties in run.config. The raws
+are patched in place.
+'''
+import sys
+from src.bamm.graphics import execution
+
+# Worker processes (see the jobs property) import this module again, so only
+# run when it's executed directly.
+if __name__ == '__main__':
+    execution.default_apply_patch(*sys.argv[1:3])
@@ -0,0 +1,88 @@
+'''
+Created on Oct 18, 2026
+
+@author: Button
+
+Times merging with serial binding and with binding in worker processes, and
+checks they agree.
+
+Run from the repository root, e.g.:
+
+    python -m benchmarks.binding "C:/DF/graphics_pack" "C:/DF/modded_raws" 4
+
+The first directory is the graphics source and the second is the target; the
+optional third argument is the number of jobs for the parallel run (default
+4). If no directories are given, the 'source' and 'target' properties from
+run.config are used.
+
+Each merge runs in a fresh session, and only the merges into output
+directories are timed. A patch is then written each way too. Outputs go in a
+temporary directory, which is deleted afterwards. The parallel run's output
+files and patch are compared byte for byte with the serial run's; the script
+exits with status 1 if any differ.
+'''
+
+import filecmp
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from src.bamm.common import config
+from src.bamm.graphics import session
+from benchmarks.session import same_trees
+
+
+def time_merge(graphics_dir, target_dir, jobs, outputdir, patchpath=None):
+    """Merge graphics_dir into target_dir with jobs jobs, in a fresh
+    session, and return the time taken.
+
+    * outputdir and patchpath are as for MergeSession.merge.
+    """
+    start = time.perf_counter()
+    merge_session = session.MergeSession([graphics_dir],
+                                         'resources/graphicstemplates.config',
+                                         'resources/ascii.config', jobs=jobs)
+    merge_session.merge(target_dir, outputdir, patchpath=patchpath)
+    merge_session.close()
+    return time.perf_counter() - start
+
+
+def main(args):
+    jobs = 4
+    if len(args) == 1 or len(args) == 3:
+        jobs = int(args[-1])
+        args = args[:-1]
+    if not args:
+        config.load_run_config()
+        args = [config.properties[config.GRAPHICS_SOURCEDIR][1],
+                config.properties[config.TARGETDIR][1]]
+    graphics_dir, target_dir = args
+    outputdir = tempfile.mkdtemp()
+    try:
+        serial_dir = os.path.join(outputdir, 'serial')
+        parallel_dir = os.path.join(outputdir, 'parallel')
+        serial_time = time_merge(graphics_dir, target_dir, 1, serial_dir)
+        parallel_time = time_merge(graphics_dir, target_dir, jobs,
+                                   parallel_dir)
+        print("serial   %8.3f s" % serial_time)
+        print("jobs=%-3i %8.3f s" % (jobs, parallel_time))
+        serial_patch = os.path.join(outputdir, 'serial.patch')
+        parallel_patch = os.path.join(outputdir, 'parallel.patch')
+        time_merge(graphics_dir, target_dir, 1, serial_dir, serial_patch)
+        time_merge(graphics_dir, target_dir, jobs, parallel_dir,
+                   parallel_patch)
+        if not same_trees(serial_dir, parallel_dir):
+            print("MISMATCH: output differs from serial binding's")
+            sys.exit(1)
+        if not filecmp.cmp(serial_patch, parallel_patch, shallow=False):
+            print("MISMATCH: patch differs from serial binding's")
+            sys.exit(1)
+        print("Output and patch identical")
+    finally:
+        shutil.rmtree(outputdir)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
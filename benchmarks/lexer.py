@@ -0,0 +1,115 @@
+'''
+Created on Oct 18, 2026
+
+@author: Button
+
+Measures tag lexing throughput, in tags per second, over a real raw set.
+
+Run from the repository root, e.g.:
+
+    python -m benchmarks.lexer "C:/DF/raw" "C:/DF/mods"
+
+Each argument is a directory to walk for .txt raw files. If no directories are
+given, the 'target' and 'source' properties from run.config are used.
+
+"before" is the line-at-a-time lexer that shipped up to v0.1, kept here
+verbatim as a reference; "after" is parsing.tags.
+'''
+
+import os
+import sys
+import time
+
+from src.bamm.common import config, parsing
+
+
+def _legacy_tags(line):
+    processed_line = _legacy_escape_problematic_literals(line)
+    to_return = []
+    while ('[' in processed_line and
+           ']' in processed_line and
+           processed_line.index('[') < processed_line.rindex(']')):
+
+        if processed_line.index(']') < processed_line.index('['):
+            processed_line = processed_line[processed_line.index('['):]
+
+        to_return.append(processed_line[processed_line.index('[')+1:
+                                        processed_line.index(']')])
+
+        processed_line = processed_line[processed_line.index(']')+1:]
+    return to_return
+
+
+def _legacy_escape_problematic_literals(line):
+    ascii_codes = parsing.ascii_codes
+    bracketscount = 0
+    count = 0
+    quotescount = 0
+    while count < len(line)-2:
+        if (((bracketscount % 2 == 0 and line[count] == "[") or
+             (bracketscount % 2 == 1 and line[count] == "]"))):
+            bracketscount += 1
+        elif (quotescount % 2 == 0 and bracketscount % 2 == 1 and
+              line[count:count+3] in ascii_codes.keys()):
+            line = line[:count] + ascii_codes[line[count:count+3]] + \
+                line[count+3:]
+        elif line[count] == "'":
+            quotescount += 1
+        elif bracketscount % 2 == 1 and line[count] == ':':
+            quotescount = 0
+        count += 1
+    return line
+
+
+def load_lines(directories):
+    """Return every line of every .txt file under directories."""
+    lines = []
+    for directory in directories:
+        for root, dirs, files in os.walk(directory):
+            for rawfile in files:
+                if '.txt' not in rawfile:
+                    continue
+                with open(os.path.join(root, rawfile), encoding='cp437') as f:
+                    lines.extend(f)
+    return lines
+
+
+def time_lexer(lexer, lines, repeat=3):
+    """Return (tag count, best wall time in seconds) for lexing lines."""
+    best = None
+    tag_count = 0
+    for _ in range(repeat):
+        tag_count = 0
+        start = time.perf_counter()
+        for line in lines:
+            tag_count += len(lexer(line))
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return tag_count, best
+
+
+def main(directories):
+    if not directories:
+        config.load_run_config()
+        directories = [config.properties[config.TARGETDIR][1],
+                       config.properties[config.GRAPHICS_SOURCEDIR][1]]
+    parsing._load_ascii_conversions('resources/ascii.config')
+    lines = load_lines(directories)
+    print("Lexing %i lines from %s" % (len(lines), ", ".join(directories)))
+
+    before_tags, before = time_lexer(_legacy_tags, lines)
+    after_tags, after = time_lexer(parsing.tags, lines)
+    if before_tags != after_tags:
+        print("WARNING: tag counts differ (before %i, after %i)" %
+              (before_tags, after_tags))
+    for label, count, elapsed in (("before", before_tags, before),
+                                  ("after", after_tags, after)):
+        print("%-7s %9i tags  %8.3f s  %12.0f tags/s" %
+              (label, count, elapsed, count / elapsed if elapsed else 0))
+    if after:
+        print("speedup %.2fx" % (before / after))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
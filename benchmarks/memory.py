@@ -0,0 +1,92 @@
+'''
+Created on Oct 18, 2026
+
+@author: Button
+
+Reports peak memory for loading (and binding) a raw corpus.
+
+Run from the repository root, e.g.:
+
+    python -m benchmarks.memory "C:/DF/graphics_pack" "C:/DF/modded_raws"
+
+The first directory is loaded as the graphics source and the second as the
+target, and the two are bound together, as in a normal run. As in a normal
+run, only the target objects which have graphics to bind are loaded. If no
+directories are given, the 'source' and 'target' properties from run.config
+are used.
+
+Peak RSS comes from the resource module, which is not available on Windows;
+there, only the node counts and timings are reported.
+'''
+
+import sys
+import time
+
+from src.bamm.common import config, parsing
+from src.bamm.graphics import graphics
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def peak_rss_megabytes():
+    """Return this process's peak RSS in megabytes, or None if unknown."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes everywhere else
+    if sys.platform == 'darwin':
+        return peak / (1024 * 1024)
+    return peak / 1024
+
+
+def count_nodes(node):
+    """Return the number of nodes in the tree rooted at node."""
+    count = 1
+    if node._children:
+        for child in node._children.values():
+            count += count_nodes(child)
+    return count
+
+
+def report(label, start):
+    rss = peak_rss_megabytes()
+    print("%-16s %8.2f s  peak RSS %s" %
+          (label, time.perf_counter() - start,
+           "unknown" if rss is None else "%.1f MB" % rss))
+
+
+def main(directories):
+    if not directories:
+        config.load_run_config()
+        directories = [config.properties[config.GRAPHICS_SOURCEDIR][1],
+                       config.properties[config.TARGETDIR][1]]
+    graphics_dir, target_dir = directories
+    parsing._load_ascii_conversions('resources/ascii.config')
+    graphics.load_all_templates('resources/graphicstemplates.config')
+    start = time.perf_counter()
+    report("startup", start)
+
+    graphics_nodes = \
+        graphics.TagNode.walk_rawfiles_into_tagnode_collection(graphics_dir)
+    target_nodes = \
+        graphics.TagNode.walk_rawfiles_into_tagnode_collection(
+            target_dir, graphics_index=graphics_nodes)
+    report("loaded", start)
+    bound_nodes = graphics.BoundNode.bind_graphics_to_targets(graphics_nodes,
+                                                              target_nodes)
+    report("bound", start)
+
+    for label, collection in (("graphics", graphics_nodes),
+                              ("target", target_nodes),
+                              ("bound", bound_nodes)):
+        print("%-8s %6i files %9i nodes" %
+              (label, len(collection),
+               sum(count_nodes(node) for nodes in collection.values()
+                   for node in nodes.values())))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
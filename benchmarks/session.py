@@ -0,0 +1,82 @@
+'''
+Created on Oct 18, 2026
+
+@author: Button
+
+Times merging one graphics source into several targets, in one MergeSession
+and in a fresh session for each target, and checks they agree.
+
+Run from the repository root, e.g.:
+
+    python -m benchmarks.session "C:/DF/graphics_pack" "C:/DF/modpack_a" "C:/DF/modpack_b"
+
+The first directory is the graphics source, and the rest are the targets.
+Outputs go in a temporary directory, which is deleted afterwards. Every output
+file from the shared session is compared with the one from its fresh
+session; the script exits with status 1 if any differ.
+'''
+
+import filecmp
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from src.bamm.graphics import session
+
+
+def new_session(graphics_dir):
+    return session.MergeSession([graphics_dir],
+                                'resources/graphicstemplates.config',
+                                'resources/ascii.config')
+
+
+def same_trees(left, right):
+    """Return True if the directories left and right hold the same files
+    with the same contents."""
+    comparison = filecmp.dircmp(left, right)
+    if comparison.left_only or comparison.right_only:
+        return False
+    if filecmp.cmpfiles(left, right, comparison.common_files,
+                        shallow=False)[1:] != ([], []):
+        return False
+    return all(same_trees(os.path.join(left, subdir),
+                          os.path.join(right, subdir))
+               for subdir in comparison.common_dirs)
+
+
+def main(args):
+    graphics_dir, target_dirs = args[0], args[1:]
+    outputdir = tempfile.mkdtemp()
+    try:
+        start = time.perf_counter()
+        for ii, target_dir in enumerate(target_dirs):
+            fresh_session = new_session(graphics_dir)
+            fresh_session.merge(target_dir,
+                                os.path.join(outputdir, 'fresh%i' % ii))
+            fresh_session.close()
+        fresh_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        shared_session = new_session(graphics_dir)
+        for ii, target_dir in enumerate(target_dirs):
+            shared_session.merge(target_dir,
+                                 os.path.join(outputdir, 'shared%i' % ii))
+        shared_session.close()
+        shared_time = time.perf_counter() - start
+
+        print("fresh sessions %8.3f s" % fresh_time)
+        print("one session    %8.3f s" % shared_time)
+        for ii in range(len(target_dirs)):
+            if not same_trees(os.path.join(outputdir, 'fresh%i' % ii),
+                              os.path.join(outputdir, 'shared%i' % ii)):
+                print("MISMATCH: output for", target_dirs[ii], "differs")
+                sys.exit(1)
+        print("%i targets merged identically" % len(target_dirs))
+    finally:
+        shutil.rmtree(outputdir)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,19 @@
+'''
+Created on Oct 18, 2026
+
+@author: Button
+
+Writes a condensed, graphics-only copy of the graphics source to the 'save'
+directory in run.config. Run it as
+
+    python condense_default.py [graphics directory] [output directory]
+
+to condense some other directory, or write somewhere else.
+'''
+import sys
+from src.bamm.graphics import execution
+
+# Worker processes (see the jobs property) import this module again, so only
+# run when it's executed directly.
+if __name__ == '__main__':
+    execution.default_condense(*sys.argv[1:3])
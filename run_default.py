@@ -5,4 +5,7 @@ Created on May 1, 2015
 '''
 from src.bamm.graphics import execution
 
-execution.default_run()
+# Worker processes (see the jobs property) import this module again, so only
+# run when it's executed directly.
+if __name__ == '__main__':
+    execution.default_run()
@@ -15,36 +15,60 @@ TARGETDIR = 'target'
 GRAPHICS_SOURCEDIR = 'source'
 EXTRA_GRAPHICS_SOURCEDIR = 'extra_source'
 OUTPUTDIR = 'output'
+PATCHFILE = 'patch'
+ARCHIVE = 'archive'
+ARCHIVE_COMPRESSION = 'archive_compression'
 GRAPHICS_OUTPUTDIR = 'save'
 TEMPLATEFILE = 'templates'
 ASCII_FILE = 'ascii'
 GRAPHICS_OVERWRITE_LIST = 'graphics_overwrite'
 GRAPHICS_IGNORE_LIST = 'graphics_ignore'
 DEBUG = 'verbose'
+TRACE = 'trace'
 USERSLOG = 'logfile'
 MODDERSLOG = 'modders_log'
+CACHEDIR = 'cache'
+CACHE_SIZE = 'cache_size'
+MATCH_CACHE_SIZE = 'match_cache_size'
+JOBS = 'jobs'
+TAG_STORE = 'tag_store'
 
 IS_DIR = 'dir'
 IS_FILE = 'file'
 IS_REGEX_LIST = 'list'
 IS_BOOL = 'bool'
+IS_INT = 'int'
 
 
 properties = {
               TARGETDIR: [IS_DIR],
               GRAPHICS_SOURCEDIR: [IS_DIR],
               OUTPUTDIR: [IS_DIR],
+              PATCHFILE: [IS_FILE],
+              ARCHIVE: [IS_FILE],
+              ARCHIVE_COMPRESSION: [IS_INT],
               GRAPHICS_OUTPUTDIR: [IS_DIR],
               TEMPLATEFILE: [IS_FILE],
               ASCII_FILE: [IS_FILE],
               GRAPHICS_OVERWRITE_LIST: [IS_REGEX_LIST],
               GRAPHICS_IGNORE_LIST: [IS_REGEX_LIST],
               DEBUG: [IS_BOOL],
+              TRACE: [IS_BOOL],
               USERSLOG: [IS_FILE],
               MODDERSLOG: [IS_FILE],
-              EXTRA_GRAPHICS_SOURCEDIR: [IS_DIR]
+              EXTRA_GRAPHICS_SOURCEDIR: [IS_DIR],
+              CACHEDIR: [IS_DIR],
+              CACHE_SIZE: [IS_INT],
+              MATCH_CACHE_SIZE: [IS_INT],
+              JOBS: [IS_INT],
+              TAG_STORE: [IS_FILE]
               }
 
+# A log level below DEBUG, for a message per tag. Turned on by the trace
+# property.
+TRACE_LEVEL = 5
+logging.addLevelName(TRACE_LEVEL, 'TRACE')
+
 userlog = logging.getLogger(USERSLOG)
 modderslog = logging.getLogger(MODDERSLOG)
 
@@ -81,11 +105,12 @@ def load_run_config():
     userlog.info("**********")
     modderslog.info("**********")
     userlog.info("Run configuration loaded.")
-    userlog.debug("Properties:")
-    for propname in properties.keys():
-        userlog.debug("Property %s:", propname)
-        for item in properties[propname]:
-            userlog.debug("\t%s", item)
+    if userlog.isEnabledFor(TRACE_LEVEL):
+        userlog.log(TRACE_LEVEL, "Properties:")
+        for propname in properties.keys():
+            userlog.log(TRACE_LEVEL, "Property %s:", propname)
+            for item in properties[propname]:
+                userlog.log(TRACE_LEVEL, "\t%s", item)
 
 
 # TODO implement parameters with defaults (and update docstring)
@@ -108,7 +133,9 @@ def initialize_logging():
     userhandler.setFormatter(fmt)
     userlog.addHandler(userhandler)
 
-    if properties[DEBUG][1]:
+    if get_property(TRACE, False):
+        userlog.setLevel(TRACE_LEVEL)
+    elif properties[DEBUG][1]:
         userlog.setLevel(logging.DEBUG)
     else:
         userlog.setLevel(logging.INFO)
@@ -131,6 +158,8 @@ def _property_has_format_error(propkey, value):
 
     * The property key is not recognized
     * The property's type is IS_BOOL and the value is not 'True' or 'False
+    * The property's type is IS_INT and the value is neither a non-negative
+    integer nor empty (which leaves an optional property unset)
     * The property's type is IS_DIR and the value is an existing
     (non-directory) file
     * The property's type is IS_FILE and the value is an existing directory.
@@ -143,7 +172,9 @@ def _property_has_format_error(propkey, value):
             (properties[propkey][0] == IS_FILE and os.path.exists(value) and
                 not os.path.isfile(value)) or
             (properties[propkey][0] == IS_BOOL and
-                value not in ('True', 'False')))
+                value not in ('True', 'False')) or
+            (properties[propkey][0] == IS_INT and value != '' and
+                not value.isdigit()))
 
 
 def set_property(prop_id, value):
@@ -154,11 +185,29 @@ def set_property(prop_id, value):
     elif not _property_has_format_error(prop_id, value):
         properties[prop_id] = properties[prop_id][:1]
         if properties[prop_id][0] == IS_REGEX_LIST:
-            properties[prop_id].extend(value.split(','))
+            # An empty list has no patterns, rather than one that matches
+            # everything.
+            properties[prop_id].extend(pattern for pattern
+                                       in value.split(',') if pattern)
         elif properties[prop_id][0] == IS_BOOL:
             if value == 'True':
                 properties[prop_id].append(True)
             elif value == 'False':
                 properties[prop_id].append(False)
+        elif properties[prop_id][0] == IS_INT:
+            if value != '':
+                properties[prop_id].append(int(value))
         else:
             properties[prop_id].append(value)
+
+
+def get_property(prop_id, default=None):
+    """ Returns the value of single-valued property prop_id.
+
+    Returns default instead if the property is missing from the run
+    configuration or has been left empty, as optional properties often are.
+    """
+    if ((prop_id not in properties.keys() or
+         len(properties[prop_id]) < 2 or properties[prop_id][1] == '')):
+        return default
+    return properties[prop_id][1]
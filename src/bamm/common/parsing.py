@@ -5,6 +5,9 @@ Created on May 21, 2015
 '''
 
 from src.bamm.common import config
+import collections
+import mmap
+import os
 import re
 import traceback
 
@@ -63,23 +66,86 @@ def _load_ascii_conversions(ascii_file):
         raise
 
 
-def tags(line):
-    """Return an ordered list of all the tags in this line, without brackets,
-    with literals escaped if necessary."""
-    processed_line = escape_problematic_literals(line)
-    to_return = []        # list of strings, a la split()
-    while ('[' in processed_line and
-           ']' in processed_line and
-           processed_line.index('[') < processed_line.rindex(']')):
+# Characters which can change the lexer's state once it is inside a tag.
+_TAG_SPECIALS = re.compile(r"[\]':]")
 
-        if processed_line.index(']') < processed_line.index('['):
-            processed_line = processed_line[processed_line.index('['):]
 
-        to_return.append(processed_line[processed_line.index('[')+1:
-                                        processed_line.index(']')])
+def lex(line):
+    """Lex line in a single pass, escaping char literals as it goes.
 
-        processed_line = processed_line[processed_line.index(']')+1:]
-    return to_return
+    Returns an ordered list of (tag, start, end) tuples, one for each tag in
+    the line.
+    * tag is the tag's contents, without brackets, with its problematic char
+    literals replaced by their cp437 codes (see escape_problematic_literals).
+    * start is the offset of the tag's opening '[' in line.
+    * end is the offset just past the tag's closing ']' in line. If the line
+    ends inside a tag which is never closed, that unterminated tag is the last
+    tuple in the list, its end is None and its tag is the escaped remainder of
+    the line.
+
+    Offsets always refer to the unescaped line that was passed in.
+    """
+    codes = ascii_codes or {}
+    found = []
+    find = line.find
+    length = len(line)
+    pos = 0
+    # Whether we've seen an odd number of quotes since the last colon inside a
+    # tag. Literals are only recognized when this is False.
+    quotes_odd = False
+    while True:
+        start = find('[', pos)
+        if start == -1:
+            return found
+        if line.count("'", pos, start) % 2 == 1:
+            quotes_odd = not quotes_odd
+        end = find(']', start + 1)
+        if find("'", start + 1, length if end == -1 else end) == -1:
+            # Fast path: no quotes, so no literals to escape in this tag.
+            if quotes_odd and find(':', start + 1, length if end == -1
+                                   else end) != -1:
+                quotes_odd = False
+            if end == -1:
+                found.append((line[start+1:], start, None))
+                return found
+            found.append((line[start+1:end], start, end+1))
+            pos = end + 1
+            continue
+
+        # Slow path: walk the tag's special characters one at a time, because
+        # a literal like '[' or ']' can hide the real end of the tag.
+        pieces = []
+        segment = start + 1
+        match = _TAG_SPECIALS.search(line, segment)
+        while match is not None:
+            ii = match.start()
+            char = line[ii]
+            if char == ']':
+                break
+            elif char == "'":
+                if not quotes_odd and line[ii:ii+3] in codes:
+                    pieces.append(line[segment:ii])
+                    pieces.append(codes[line[ii:ii+3]])
+                    segment = ii + 3
+                    match = _TAG_SPECIALS.search(line, segment)
+                    continue
+                quotes_odd = not quotes_odd
+            else:
+                quotes_odd = False
+            match = _TAG_SPECIALS.search(line, ii + 1)
+        if match is None:
+            pieces.append(line[segment:])
+            found.append(("".join(pieces), start, None))
+            return found
+        pieces.append(line[segment:ii])
+        found.append(("".join(pieces), start, ii+1))
+        pos = ii + 1
+
+
+def tags(line):
+    """Return an ordered list of all the tags in this line, without brackets,
+    with literals escaped if necessary."""
+    return [tag for tag, start, end in lex(line) if end is not None]
 
 
 def escape_problematic_literals(line):
@@ -90,48 +156,145 @@ def escape_problematic_literals(line):
     the DF raw characters ']', '[' and ':' are allowed within a tag outside
     their uses, and since cp437 codes are equally valid, replacing these with
     their cp437 codes is harmless and streamlines lexing considerably.
+
+    Literal colons are going to require some special processing, because of
+    the following case:  GROWTH:'r':'x': etc. That's why we can't just use a
+    blind replaceAll; see lex for the details.
     """
-    global ascii_codes
+    return escape_lexed(line, lex(line))
+
+
+def escape_lexed(line, lexed):
+    """Return line with its literals escaped, given lexed = lex(line).
+
+    This lets callers which need both the tags and the escaped line lex the
+    line only once.
+    """
+    pieces = []
+    pos = 0
+    for tag, start, end in lexed:
+        pieces.append(line[pos:start+1])
+        pieces.append(tag)
+        if end is None:
+            return "".join(pieces)
+        pos = end - 1
+    pieces.append(line[pos:])
+    return "".join(pieces)
+
+
+TagRecord = collections.namedtuple('TagRecord',
+                                   ['line_no', 'byte_offset', 'tag',
+                                    'end_offset'])
+TagRecord.__doc__ = """A tag found in a raw file by iter_raw_tags.
+
+* line_no is the 1-based number of the line holding the tag's opening '['.
+* byte_offset is the offset of that '[' in the file.
+* tag is the tag's contents, as returned by tags().
+* end_offset is the offset just past the tag's closing ']' in the file.
+"""
+
+
+def iter_raw_tags(path):
+    """Yield a TagRecord for each tag in the raw file at path, in order.
+
+    The file is memory-mapped and scanned once, lazily; see
+    iter_buffer_tags for the details.
+    """
+    with open(path, 'rb') as rawfile:
+        if os.fstat(rawfile.fileno()).st_size == 0:
+            return
+        with mmap.mmap(rawfile.fileno(), 0,
+                       access=mmap.ACCESS_READ) as buffer:
+            yield from iter_buffer_tags(buffer)
+
+
+def iter_buffer_tags(buffer):
+    """Yield a TagRecord for each tag in buffer, a cp437-encoded raw file.
+
+    buffer can be bytes or anything else that supports find and slicing the
+    same way, such as an mmap. Since cp437 is a single-byte encoding, offsets
+    in the buffer are also offsets in the decoded text.
+
+    Tags may span line breaks, as DF allows: a tag left open at the end of a
+    line is continued onto the following lines until it is closed. The line
+    breaks are dropped from the tag. If a '[' turns up before the tag is
+    closed, the open tag is treated as stray text and dropped, as it would
+    be by tags().
+    """
+    size = len(buffer)
+    line_no = 0
+    line_start = 0
+    # (line_no, byte_offset) of a tag left open on an earlier line
+    pending = None
+    while line_start < size:
+        line_end = buffer.find(b'\n', line_start)
+        line_end = size if line_end == -1 else line_end + 1
+        line_no += 1
+        base = line_start
+        if pending is not None:
+            close = buffer.find(b']', line_start, line_end)
+            reopen = buffer.find(b'[', line_start, line_end)
+            if reopen != -1 and (close == -1 or reopen < close):
+                pending = None
+            elif close == -1:
+                line_start = line_end
+                continue
+            else:
+                base = pending[1]
+        text = buffer[base:line_end].decode('cp437')
+        for tag, start, end in lex(text):
+            if base != line_start and start == 0:
+                tag_line = pending[0]
+                tag = tag.replace('\r', '').replace('\n', '')
+            else:
+                tag_line = line_no
+            if end is None:
+                pending = (tag_line, base + start)
+                break
+            yield TagRecord(tag_line, base + start, tag, base + end)
+        else:
+            pending = None
+        line_start = line_end
+
+
+class PathMatcher():
+    """Matches paths against a list of path regexes, like graphics_ignore.
+
+    The list is compiled once into a single alternation, so each path costs
+    one regex match no matter how many patterns there are. As with re.match,
+    each pattern is anchored at the start of the path. Slashes are normalized
+    to '/' in both the patterns and the paths.
+
+    Verdicts are cached per path, since the same trees get walked more than
+    once in a run.
+    """
+
+    def __init__(self, patterns):
+        """ Initializes a PathMatcher
+
+        * patterns is an iterable of regex strings. A path matches if any of
+        them matches it.
+        """
+        normalized = [pattern.replace('\\', '/') for pattern in patterns]
+        if normalized:
+            self._regex = re.compile('|'.join('(?:' + pattern + ')'
+                                              for pattern in normalized))
+        else:
+            self._regex = None
+        self._verdicts = {}
+
+    @staticmethod
+    def from_property(prop_id):
+        """Return a PathMatcher for the regex list property prop_id, e.g.
+        config.GRAPHICS_IGNORE_LIST."""
+        return PathMatcher(config.properties[prop_id][1:])
 
-    # Replace literal key characters with number codes
-    # Literal colons are going to require some special processing, because of
-    # the following case:  GROWTH:'r':'x': etc. That's why we can't just use
-    # a blind replaceAll.
-
-    # If odd, we are inside a tag. If even, we are outside a tag.
-    bracketscount = 0
-    count = 0                # Where we are in the string
-    quotescount = 0
-    while count < len(line)-2:
-        # Going from inside a tag to outside or vice versa
-        if (((bracketscount % 2 == 0 and line[count] == "[") or
-             (bracketscount % 2 == 1 and line[count] == "]"))):
-            bracketscount += 1
-        # We are inside a tag and we have discovered a ' character beginning a
-        # literal value, with another 2 characters down on the other side.
-        elif (quotescount % 2 == 0 and bracketscount % 2 == 1 and
-              line[count:count+3] in ascii_codes.keys()):
-            # If the character could be a problem for later processing, replace
-            #  it with its ascii code.
-            line = line[:count] + ascii_codes[line[count:count+3]] + \
-                line[count+3:]
-        elif line[count] == "'":
-            quotescount += 1
-        elif bracketscount % 2 == 1 and line[count] == ':':
-            quotescount = 0
-        count += 1
-    # line has now had its literal "use this tile" versions of its special
-    # characters replaced with their numbers.
-    return line
-
-
-def path_compatible(full_path, allowed_paths):
-    """Return True if full_path regex matches anything in allowed_paths, or
-    False otherwise."""
-    full_path = full_path.replace('\\', '/')
-    for allowed_path in allowed_paths:
-        allowed_path = allowed_path.replace('\\', '/')
-        match = re.match(allowed_path, full_path)
-        if match is not None:
-            return True
-    return False
+    def matches(self, path):
+        """Return True if path matches any of this matcher's patterns."""
+        try:
+            return self._verdicts[path]
+        except KeyError:
+            verdict = (self._regex is not None and
+                       self._regex.match(path.replace('\\', '/')) is not None)
+            self._verdicts[path] = verdict
+            return verdict
@@ -0,0 +1,232 @@
+'''
+Created on Oct 18, 2026
+
+@author: Button
+'''
+
+from src.bamm.common import config, parsing
+import hashlib
+import marshal
+import os
+import struct
+import sys
+import traceback
+import zlib
+
+raw_cache = None
+
+userlog = config.userlog
+
+FORMAT_VERSION = 1
+_MAGIC = b'BAMMLEX'
+# magic, format version, file size, file mtime in ns, content digest, lexer
+# digest
+_HEADER = struct.Struct('<7sHQq16s16s')
+_ENTRY_SUFFIX = '.lex'
+
+
+def load_cache(directory, max_megabytes=None):
+    """Initialize the lexed-raw cache in directory.
+
+    * directory is where cache entries are kept. It is created if necessary.
+    * max_megabytes is the size the cache is trimmed back to after each use.
+    If it is None, the cache is never trimmed.
+
+    The cache is stored in rawcache.raw_cache, where raw_tags will find it.
+    """
+    global raw_cache
+    userlog.info("Loading lexed-raw cache from %s ...", directory)
+    try:
+        os.makedirs(directory, exist_ok=True)
+    except OSError:
+        userlog.warning("Could not create cache directory %s ; raws will " +
+                        "not be cached.", directory)
+        userlog.warning(traceback.format_exc())
+        raw_cache = None
+    else:
+        if max_megabytes is None:
+            raw_cache = RawCache(directory)
+        else:
+            raw_cache = RawCache(directory, max_megabytes * 1024 * 1024)
+
+
+def raw_tags(path, content=None):
+    """Return the tags of the raw file at path as a sequence of TagRecords.
+
+    * content is the file's contents, as bytes, if the caller has already
+    read it. Then the file isn't read again.
+
+    If a cache has been loaded with load_cache, the tags come from it where
+    possible; otherwise the file is lexed with parsing.iter_raw_tags.
+    """
+    if raw_cache is None:
+        if content is None:
+            return parsing.iter_raw_tags(path)
+        return parsing.iter_buffer_tags(content)
+    else:
+        return raw_cache.tags(path, content)
+
+
+class RawCache():
+    """A persistent cache of the tag streams of raw files.
+
+    Each raw file gets one entry, named after a hash of its absolute path.
+    An entry holds a header and a compressed, column-wise marshal of the
+    file's TagRecords. The header records the file's size, mtime and content
+    digest, plus a digest of the ASCII conversions it was lexed with, since
+    those change the tags themselves.
+
+    An entry is used if the file's size and mtime still match. If only the
+    mtime differs, the content digest decides, so touched or re-copied files
+    don't need to be lexed again.
+
+    Members:
+        * _directory is the directory the entries are stored in.
+        * _max_bytes is the total entry size trim() cuts the cache back to,
+        or None for no limit.
+        * _lexer_codes and _lexer_digest are the ASCII conversions the
+        lexer digest was last worked out for, and that digest. The
+        conversions are checked on every lookup, since they may be loaded,
+        or changed, after the cache is.
+        * hits and misses count tags() calls served from the cache or not.
+    """
+
+    def __init__(self, directory, max_bytes=None):
+        self._directory = directory
+        self._max_bytes = max_bytes
+        self._lexer_codes = None
+        self._lexer_digest = None
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def directory(self):
+        """The directory the entries are stored in."""
+        return self._directory
+
+    def _digest_lexer(self):
+        """Return a digest of everything besides a file's contents which
+        affects how it is lexed, as things stand now."""
+        codes = dict(parsing.ascii_codes or {})
+        if self._lexer_digest is None or codes != self._lexer_codes:
+            lexer_info = repr((sorted(codes.items()), sys.version_info[:2],
+                               marshal.version))
+            self._lexer_codes = codes
+            self._lexer_digest = hashlib.blake2b(
+                lexer_info.encode('utf-8'), digest_size=16).digest()
+        return self._lexer_digest
+
+    def _entry_path(self, path):
+        key = hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()
+        return os.path.join(self._directory, key + _ENTRY_SUFFIX)
+
+    def tags(self, path, content=None):
+        """Return the tags of the raw file at path as a list of TagRecords,
+        from the cache if there's a valid entry, or by lexing it otherwise.
+
+        * content is the file's contents, as bytes, if they've already been
+        read.
+        """
+        stat = os.stat(path)
+        entry_path = self._entry_path(path)
+        current_lexer_digest = self._digest_lexer()
+        try:
+            with open(entry_path, 'rb') as entry:
+                (magic, version, size, mtime, digest,
+                 lexer_digest) = _HEADER.unpack(entry.read(_HEADER.size))
+                payload = entry.read()
+        except (OSError, struct.error):
+            magic = None
+
+        if ((magic == _MAGIC and version == FORMAT_VERSION and
+             lexer_digest == current_lexer_digest and size == stat.st_size)):
+            is_touched = mtime != stat.st_mtime_ns
+            is_fresh = not is_touched
+            if is_touched:
+                if content is None:
+                    with open(path, 'rb') as rawfile:
+                        content = rawfile.read()
+                is_fresh = RawCache._digest(content) == digest
+            records = None
+            if is_fresh:
+                try:
+                    records = RawCache._decode(payload)
+                except (ValueError, EOFError, TypeError, zlib.error):
+                    userlog.warning("Discarding corrupt cache entry %s",
+                                    entry_path)
+            if records is not None:
+                self.hits += 1
+                if not is_touched:
+                    # Mark the entry as recently used, for trim()
+                    os.utime(entry_path)
+                else:
+                    userlog.debug("%s was touched but is unchanged.", path)
+                    self._store(entry_path, stat, content, records,
+                                current_lexer_digest)
+                return records
+
+        self.misses += 1
+        if content is None:
+            with open(path, 'rb') as rawfile:
+                content = rawfile.read()
+        records = list(parsing.iter_buffer_tags(content))
+        self._store(entry_path, stat, content, records, current_lexer_digest)
+        return records
+
+    def _store(self, entry_path, stat, content, records, lexer_digest):
+        header = _HEADER.pack(_MAGIC, FORMAT_VERSION, stat.st_size,
+                              stat.st_mtime_ns, RawCache._digest(content),
+                              lexer_digest)
+        temp_path = entry_path + '.tmp'
+        try:
+            with open(temp_path, 'wb') as entry:
+                entry.write(header)
+                entry.write(RawCache._encode(records))
+            os.replace(temp_path, entry_path)
+        except OSError:
+            userlog.warning("Could not write cache entry %s", entry_path)
+            userlog.warning(traceback.format_exc())
+
+    @staticmethod
+    def _digest(content):
+        return hashlib.blake2b(content, digest_size=16).digest()
+
+    @staticmethod
+    def _encode(records):
+        columns = ([record.line_no for record in records],
+                   [record.byte_offset for record in records],
+                   [record.tag for record in records],
+                   [record.end_offset for record in records])
+        return zlib.compress(marshal.dumps(columns), 1)
+
+    @staticmethod
+    def _decode(payload):
+        columns = marshal.loads(zlib.decompress(payload))
+        return [parsing.TagRecord._make(record) for record in zip(*columns)]
+
+    def trim(self):
+        """Delete the least recently used entries until the cache fits in
+        its size limit."""
+        if self._max_bytes is None:
+            return
+        entries = []
+        total = 0
+        with os.scandir(self._directory) as scan:
+            for dir_entry in scan:
+                if dir_entry.name.endswith(_ENTRY_SUFFIX):
+                    stat = dir_entry.stat()
+                    entries.append((stat.st_mtime_ns, stat.st_size,
+                                    dir_entry.path))
+                    total += stat.st_size
+        if total <= self._max_bytes:
+            return
+        entries.sort()
+        for mtime, size, entry_path in entries:
+            try:
+                os.remove(entry_path)
+            except OSError:
+                continue
+            total -= size
+            if total <= self._max_bytes:
+                break
+        userlog.info("Trimmed lexed-raw cache to %i bytes.", total)
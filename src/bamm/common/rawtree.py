@@ -0,0 +1,166 @@
+'''
+Created on Oct 18, 2026
+
+@author: Button
+'''
+
+from src.bamm.common import config
+import collections
+import os
+import sys
+
+userlog = config.userlog
+
+# Kinds of file in a RawTreeIndex
+RAW = 'raw'
+IGNORED = 'ignored'
+OVERWRITE = 'overwrite'
+OTHER = 'other'
+
+IndexedFile = collections.namedtuple('IndexedFile', ['path', 'stat', 'kind'])
+
+
+class RawTreeIndex():
+    """An index of every file under a raw directory, such as the target or a
+    graphics source, built in a single os.scandir pass.
+
+    Files are keyed by their path relative to the directory. Each one is
+    classified as one of:
+        * OVERWRITE: it matches the overwrite matcher, and is to be copied over
+        the target's file as it is.
+        * IGNORED: it matches the ignore matcher, and is copied as it is.
+        * RAW: it's a .txt file, and is loaded as raws.
+        * OTHER: anything else, which is copied as it is.
+    Matchers are given each file's relative path with a '/' in front, e.g.
+    '/data/art/font.png', so patterns like '.*/art/.*' match wherever the
+    directory itself is.
+
+    Members:
+        * directory is the directory indexed.
+        * dirs is a list of the relative paths of its subdirectories, parents
+        before children.
+        * files is a dict mapping each file's relative path to an IndexedFile
+        of its full path, os.stat_result and kind, in sorted walk order.
+        * _relpaths_by_name maps each raw file's name to the relative paths of
+        the raw files with that name.
+    """
+
+    def __init__(self, directory, ignore_matcher=None,
+                 overwrite_matcher=None):
+        """Index directory.
+
+        * ignore_matcher and overwrite_matcher are optional
+        parsing.PathMatchers, for the IGNORED and OVERWRITE kinds.
+        """
+        self.directory = directory
+        self.dirs = []
+        self.files = {}
+        self._relpaths_by_name = {}
+        self._ignore_matcher = ignore_matcher
+        self._overwrite_matcher = overwrite_matcher
+        self._scan(directory, '')
+        userlog.info("Indexed %i files in %s .", len(self.files), directory)
+
+    def _scan(self, directory, reldir):
+        with os.scandir(directory) as scan:
+            entries = sorted(scan, key=lambda entry: entry.name)
+        subdirs = []
+        for entry in entries:
+            relpath = os.path.join(reldir, entry.name)
+            if entry.is_dir():
+                # Like os.walk, don't follow links to directories, so a link
+                # loop can't recurse forever, and nothing is indexed twice.
+                if entry.is_symlink():
+                    userlog.info("Not following directory link %s .",
+                                 entry.path)
+                else:
+                    subdirs.append((entry.path, relpath))
+                continue
+            kind = self._classify(relpath)
+            if kind == RAW:
+                # Raw file paths are dict keys all through a run.
+                relpath = sys.intern(relpath)
+                self._relpaths_by_name.setdefault(entry.name, []).append(
+                    relpath)
+            self.files[relpath] = IndexedFile(entry.path, entry.stat(), kind)
+        for path, relpath in subdirs:
+            self.dirs.append(relpath)
+            self._scan(path, relpath)
+
+    def _classify(self, relpath):
+        matched_path = '/' + relpath
+        if ((self._overwrite_matcher is not None and
+             self._overwrite_matcher.matches(matched_path))):
+            return OVERWRITE
+        elif ((self._ignore_matcher is not None and
+               self._ignore_matcher.matches(matched_path))):
+            return IGNORED
+        # Only look at .txt files
+        elif '.txt' in os.path.basename(relpath):
+            return RAW
+        else:
+            return OTHER
+
+    def relpaths(self, kind):
+        """Return a list of the relative paths of the files of kind, in
+        walk order."""
+        return [relpath for relpath, indexed in self.files.items()
+                if indexed.kind == kind]
+
+    def relpaths_named(self, name):
+        """Return a list of the relative paths of the raw files named name."""
+        return self._relpaths_by_name.get(name, [])
+
+
+def pair_rawfiles(target_tree, graphics_trees):
+    """Work out which graphics source file goes with each target raw file.
+
+    * target_tree is the RawTreeIndex of the target.
+    * graphics_trees is a list of the RawTreeIndexes of the graphics sources.
+
+    A target raw file goes with the graphics raw file at the same relative
+    path. If there isn't one, it goes with the graphics raw file of the same
+    name, so long as there's only one; if there are several, none of them is
+    picked, and that's logged.
+
+    Returns a dict mapping target relative paths to graphics relative paths,
+    for the target raw files which have a graphics file.
+    """
+    graphics_relpaths = set()
+    for graphics_tree in graphics_trees:
+        graphics_relpaths.update(graphics_tree.relpaths(RAW))
+    pairs = {}
+    for relpath in target_tree.relpaths(RAW):
+        if relpath in graphics_relpaths:
+            pairs[relpath] = relpath
+            continue
+        named = set()
+        for graphics_tree in graphics_trees:
+            named.update(graphics_tree.relpaths_named(
+                os.path.basename(relpath)))
+        if len(named) == 1:
+            pairs[relpath] = named.pop()
+        elif len(named) > 1:
+            userlog.warning("%s has no graphics file at the same path, and " +
+                            "there are several with its name: %s . It won't " +
+                            "be merged.", relpath, ", ".join(sorted(named)))
+    return pairs
+
+
+def changed_files(old_tree, new_tree):
+    """Return the set of the relative paths of the files which have been
+    added, removed or changed between old_tree and new_tree, two
+    RawTreeIndexes of the same directory.
+
+    A file counts as changed if its size, mtime or kind is different; its
+    contents aren't read.
+    """
+    changed = set(old_tree.files.keys()) ^ set(new_tree.files.keys())
+    for relpath, indexed in new_tree.files.items():
+        old_indexed = old_tree.files.get(relpath)
+        if ((old_indexed is not None and
+             (old_indexed.kind != indexed.kind or
+              old_indexed.stat.st_size != indexed.stat.st_size or
+              old_indexed.stat.st_mtime_ns != indexed.stat.st_mtime_ns))):
+            changed.add(relpath)
+    return changed
@@ -0,0 +1,157 @@
+'''
+Created on Oct 18, 2026
+
+@author: Button
+'''
+
+from src.bamm.common import config
+import io
+import os
+import tarfile
+import threading
+import time
+import zipfile
+
+userlog = config.userlog
+
+# The tarfile mode for each kind of tar archive, by file extension.
+_TAR_MODES = (('.tar', 'w'),
+              ('.tar.gz', 'w:gz'),
+              ('.tgz', 'w:gz'),
+              ('.tar.bz2', 'w:bz2'),
+              ('.tar.xz', 'w:xz'))
+
+
+def archive_type(path):
+    """Return the kind of archive path names by its extension: 'zip' for a
+    zip file, or the tarfile mode to write it with for a tar file.
+
+    Raises a ValueError if it's neither.
+    """
+    lower_path = path.lower()
+    if lower_path.endswith('.zip'):
+        return 'zip'
+    for suffix, mode in _TAR_MODES:
+        if lower_path.endswith(suffix):
+            return mode
+    userlog.error("%s is not a .zip, .tar, .tar.gz, .tgz, .tar.bz2 or " +
+                  ".tar.xz file.", path)
+    raise ValueError("Unknown archive type: " + path)
+
+
+class OutputArchive():
+    """A zip or tar archive for write_modified_raws to write the output files
+    into, in place of the output directory.
+
+    Merged files go straight from memory into the archive, and copied files
+    are streamed into it from the target source as they are, so nothing is
+    written out to disk only to be read back in again. The kind of archive
+    depends on the extension of its path: .zip, .tar, .tar.gz (or .tgz),
+    .tar.bz2 or .tar.xz.
+
+    The archive is built in a temporary file next to it, which close() moves
+    into place, so a failed run never leaves a half-written archive behind.
+
+    Members:
+        * root is the path of the archive. The paths passed to add_directory,
+        write and copy are under it, as if it were the output directory.
+        * _temp_path is the temporary file the archive is built in.
+        * _zip and _tar are the open archive; only one of them is set.
+        * _lock keeps writes from several threads from interleaving. Entries
+        are added in the order their files are finished in, so with more
+        than one job their order in the archive can vary.
+    """
+
+    def __init__(self, path, compression=None):
+        """Start a new archive at path.
+
+        * compression is the compression level, from 0 (none) to 9 (most).
+        If it's None, the library's default level is used. It's ignored for
+        plain .tar files.
+        """
+        self.root = path
+        self._temp_path = path + '.tmp'
+        self._lock = threading.Lock()
+        self._zip = None
+        self._tar = None
+        mode = archive_type(path)
+        if mode == 'zip':
+            if compression == 0:
+                self._zip = zipfile.ZipFile(self._temp_path, 'w',
+                                            zipfile.ZIP_STORED)
+            else:
+                self._zip = zipfile.ZipFile(self._temp_path, 'w',
+                                            zipfile.ZIP_DEFLATED,
+                                            compresslevel=compression)
+        else:
+            options = {}
+            if compression is not None and mode == 'w:xz':
+                options['preset'] = compression
+            elif compression is not None and mode != 'w':
+                options['compresslevel'] = compression
+            self._tar = tarfile.open(self._temp_path, mode, **options)
+        userlog.info("Writing output to archive %s ...", path)
+
+    def _arcname(self, path):
+        return os.path.relpath(path, self.root).replace(os.sep, '/')
+
+    def add_directory(self, path):
+        """Add an entry for the directory at path."""
+        arcname = self._arcname(path)
+        with self._lock:
+            if self._zip is not None:
+                info = zipfile.ZipInfo(arcname + '/', time.localtime()[:6])
+                # Unix directory mode, and the MS-DOS directory flag
+                info.external_attr = (0o40755 << 16) | 0x10
+                self._zip.writestr(info, b'')
+            else:
+                info = tarfile.TarInfo(arcname)
+                info.type = tarfile.DIRTYPE
+                info.mode = 0o755
+                info.mtime = time.time()
+                self._tar.addfile(info)
+
+    def write(self, path, data):
+        """Add a file at path with data, a bytes object, as its contents."""
+        arcname = self._arcname(path)
+        with self._lock:
+            if self._zip is not None:
+                self._zip.writestr(arcname, data)
+            else:
+                info = tarfile.TarInfo(arcname)
+                info.size = len(data)
+                info.mode = 0o644
+                info.mtime = time.time()
+                self._tar.addfile(info, io.BytesIO(data))
+
+    def copy(self, sourcepath, path):
+        """Add a file at path with the contents of the file at sourcepath.
+
+        The file is streamed in as it is, without being decoded.
+        """
+        arcname = self._arcname(path)
+        with self._lock:
+            if self._zip is not None:
+                self._zip.write(sourcepath, arcname)
+            else:
+                self._tar.add(sourcepath, arcname, recursive=False)
+
+    def close(self):
+        """Finish the archive and move it into place."""
+        if self._zip is not None:
+            self._zip.close()
+        else:
+            self._tar.close()
+        os.replace(self._temp_path, self.root)
+        userlog.info("Archive written to %s .", self.root)
+
+    def discard(self):
+        """Abandon the archive, deleting the temporary file."""
+        if self._zip is not None:
+            self._zip.close()
+        else:
+            self._tar.close()
+        try:
+            os.remove(self._temp_path)
+        except OSError:
+            pass
@@ -4,42 +4,141 @@ Created on May 21, 2015
 @author: Button
 '''
 
-from src.bamm.common import config, parsing
-from src.bamm.graphics import graphics
+import os
+from src.bamm.common import config, parsing, rawcache, rawtree
+from src.bamm.graphics import graphics, session
 
 
 def default_run():
     print("Running with default options.")
-    default_setup()
+    config.load_run_config()
+    _load_raw_cache()
+    # The session loads the templates and ASCII conversions itself.
     default_gen_new_raws()
 
 
+def default_watch(interval=1.0):
+    """Merge with the default options, then keep merging whenever the
+    source, extra_source or target changes, until interrupted with Ctrl+C.
+
+    * interval is how many seconds to wait between looks for changes.
+    """
+    print("Watching with default options. Press Ctrl+C to stop.")
+    config.load_run_config()
+    _load_raw_cache()
+    merge_session = session.MergeSession.from_config()
+    try:
+        merge_session.watch(
+            config.properties[config.TARGETDIR][1],
+            config.properties[config.OUTPUTDIR][1],
+            interval,
+            patchpath=config.get_property(config.PATCHFILE),
+            archivepath=config.get_property(config.ARCHIVE),
+            archive_compression=config.get_property(
+                config.ARCHIVE_COMPRESSION))
+    except KeyboardInterrupt:
+        print("Stopped watching.")
+    finally:
+        merge_session.close()
+
+
+def default_apply_patch(patchpath=None, directory=None):
+    """Apply a patch written by a run with the patch property set.
+
+    * patchpath is the patch file. It defaults to the patch property.
+    * directory holds the raws to patch, in place. It defaults to the target
+    property.
+    """
+    config.load_run_config()
+    if patchpath is None:
+        patchpath = config.properties[config.PATCHFILE][1]
+    if directory is None:
+        directory = config.properties[config.TARGETDIR][1]
+    failed = graphics.apply_patch(patchpath, directory)
+    if failed:
+        print("Could not patch", len(failed), "files; see the log for details.")
+    else:
+        print("Patch applied.")
+
+
+def default_condense(directory=None, outputdir=None):
+    """Write a condensed, graphics-only copy of a graphics source.
+
+    * directory is the graphics source to condense. It defaults to the
+    source property (plus extra_source, if set).
+    * outputdir is where the condensed raws go. It defaults to the save
+    property.
+
+    The condensed raws, along with the files matching graphics_overwrite,
+    copied as they are, can then be used as the source in later runs.
+    """
+    default_setup()
+    if directory is None:
+        directories = [config.properties[config.GRAPHICS_SOURCEDIR][1]]
+        if config.get_property(config.EXTRA_GRAPHICS_SOURCEDIR) is not None:
+            directories.append(
+                config.properties[config.EXTRA_GRAPHICS_SOURCEDIR][1])
+    else:
+        directories = [directory]
+    if outputdir is None:
+        outputdir = config.properties[config.GRAPHICS_OUTPUTDIR][1]
+    graphics_trees = _index_graphics(directories)
+    graphics_tags_by_file = {}
+    for graphics_tree in graphics_trees:
+        graphics_tags_by_file = \
+            graphics.TagNode.walk_rawfiles_into_tagnode_collection(
+                graphics_tree, graphics_tags_by_file,
+                jobs=config.get_property(config.JOBS, 1))
+    graphics.write_condensed_raws(
+        graphics_tags_by_file, outputdir,
+        graphics.find_graphics_overrides(graphics_trees))
+
+
+def _index_graphics(graphics_dirs):
+    """Return a list of RawTreeIndexes of graphics_dirs, classified by the
+    graphics_ignore and graphics_overwrite properties."""
+    ignore_matcher = parsing.PathMatcher.from_property(
+        config.GRAPHICS_IGNORE_LIST)
+    overwrite_matcher = parsing.PathMatcher.from_property(
+        config.GRAPHICS_OVERWRITE_LIST)
+    return [rawtree.RawTreeIndex(graphics_dir, ignore_matcher,
+                                 overwrite_matcher)
+            for graphics_dir in graphics_dirs]
+
+
 def default_setup():
     config.load_run_config()
     parsing._load_ascii_conversions(config.properties[config.ASCII_FILE][1])
-    graphics.load_all_templates(config.properties[config.TEMPLATEFILE][1])
+    cache_dir = _load_raw_cache()
+    template_artifact = None
+    if cache_dir is not None:
+        template_artifact = os.path.join(cache_dir, 'templates.bin')
+    graphics.load_all_templates(config.properties[config.TEMPLATEFILE][1],
+                                template_artifact)
+    graphics.load_match_cache(config.get_property(config.MATCH_CACHE_SIZE,
+                                                  100000))
+
+
+def _load_raw_cache():
+    """Load the lexed-raw cache, if the cache property is set, and return
+    the cache directory (or None)."""
+    cache_dir = config.get_property(config.CACHEDIR)
+    if cache_dir is not None:
+        rawcache.load_cache(cache_dir, config.get_property(config.CACHE_SIZE))
+    return cache_dir
 
 
 def default_gen_new_raws():
-    graphics_tags_by_file = \
-        graphics.TagNode.walk_rawfiles_into_tagnode_collection(
-            config.properties[config.GRAPHICS_SOURCEDIR][1])
-    
-    # Optional extra_graphics property
+    """Merge the graphics source into the target, with the settings in the
+    run config, in a MergeSession of its own."""
+    merge_session = session.MergeSession.from_config()
     try:
-        dir = config.properties[config.EXTRA_GRAPHICS_SOURCEDIR][1]
-    except:
-        pass
-    else:
-        graphics_tags_by_file = \
-            graphics.TagNode.walk_rawfiles_into_tagnode_collection(dir, graphics_tags_by_file)
-
-    target_tags_by_file = \
-        graphics.TagNode.walk_rawfiles_into_tagnode_collection(
-            config.properties[config.TARGETDIR][1])
-    tags_to_apply = \
-        graphics.BoundNode.bind_graphics_to_targets(graphics_tags_by_file,
-                                                    target_tags_by_file)
-    graphics.write_modified_raws(tags_to_apply,
-                                 config.properties[config.TARGETDIR][1],
-                                 config.properties[config.OUTPUTDIR][1])
+        merge_session.merge(
+            config.properties[config.TARGETDIR][1],
+            config.properties[config.OUTPUTDIR][1],
+            patchpath=config.get_property(config.PATCHFILE),
+            archivepath=config.get_property(config.ARCHIVE),
+            archive_compression=config.get_property(
+                config.ARCHIVE_COMPRESSION))
+    finally:
+        merge_session.close()
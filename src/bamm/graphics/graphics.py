@@ -1,29 +1,94 @@
+import collections
+import concurrent.futures
+import errno
+import hashlib
+import json
+import logging
 import os
+import pickle
+import re
 import shutil
+import struct
+import sys
+import threading
 import traceback
-from src.bamm.common import config, parsing
+import types
+from src.bamm.common import config, parsing, rawcache, rawtree
 
 template_tree = None
+match_cache = None
+# Maps each TemplateNode to its index in _template_list(), in worker
+# processes only.
+_worker_template_indexes = None
+
+# Bump this whenever the template classes change shape, so stale template
+# artifacts get rebuilt instead of loaded.
+TEMPLATE_ARTIFACT_VERSION = 2
+_ARTIFACT_MAGIC = b'BAMMTPL'
+# magic, version, sha256 of the template file
+_ARTIFACT_HEADER = struct.Struct('<7sH32s')
 
 userlog = config.userlog
 modderslog = config.modderslog
 
+# One change to a target raw file; see BoundNode.compile_edit_script.
+Edit = collections.namedtuple('Edit', ['offset', 'end', 'replacement',
+                                       'missing', 'additional'])
+
+# The raw object type of each kind of top-level tag, for the [OBJECT:...]
+# headers of condensed raws.
+_OBJECT_TYPES = {'BUILDING_FURNACE': 'BUILDING',
+                 'BUILDING_WORKSHOP': 'BUILDING',
+                 'CREATURE': 'CREATURE',
+                 'CREATURE_GRAPHICS': 'GRAPHICS',
+                 'ENTITY': 'ENTITY',
+                 'INORGANIC': 'INORGANIC',
+                 'ITEM_TOOL': 'ITEM',
+                 'MATERIAL_TEMPLATE': 'MATERIAL_TEMPLATE',
+                 'PLANT': 'PLANT',
+                 'TILE_PAGE': 'GRAPHICS',
+                 'TRANSLATION': 'LANGUAGE'}
+
+# What _write_output_file does with a file
+_MERGE = 'merge'
+_COPY_TARGET = 'copy target'
+_COPY_GRAPHICS = 'copy graphics'
+
+# Bump this whenever the patch file format changes.
+PATCH_FORMAT_VERSION = 1
+_PATCH_FORMAT = 'BAMM patch'
+
+# Shared stand-in for the containers of nodes that have nothing in them yet.
+# Most TagNodes and BoundNodes never get children, so they don't get dicts
+# of their own until they need them.
+_EMPTY = types.MappingProxyType({})
+
 
 # TODO overhaul.
-def load_all_templates(templatefile):
+def load_all_templates(templatefile, artifact=None):
     """ Loads config information from templatefile.
 
     * templatefile is a pipe-delimited, one-graphics-tag-per-line config file
     which should not be changed by users unless you REALLY know what you're
     doing.
+    * artifact is an optional path to a precompiled template tree (see
+    build_template_artifact). If it was built from the current contents of
+    templatefile, the tree is loaded from it in one go; otherwise
+    templatefile is parsed as usual and the artifact is rebuilt.
 
     This initializes the scaffolding for all future raw parsing, which is
     stored in graphics.template_tree .
     """
+    global template_tree
     try:
         userlog.info("Loading template configuration...")
+        if artifact is not None and template_tree is None:
+            template_tree = _load_template_artifact(templatefile, artifact)
+            if template_tree is not None:
+                userlog.info("Template configuration loaded from %s .",
+                             artifact)
+                return
         alltemplates = open(templatefile, 'r')
-        global template_tree
         if template_tree is None:
             # initialize the template tree
             template_tree = TemplateNode(None)
@@ -41,6 +106,7 @@ def load_all_templates(templatefile):
 
                 curr_node._is_graphics_tag = True
         alltemplates.close()
+        _build_all_dispatch(template_tree)
         userlog.info("Template configuration loaded.")
     except:
         userlog.error("Exception in loading templates. " +
@@ -49,162 +115,655 @@ def load_all_templates(templatefile):
                       "Otherwise, please contact a BAMM! developer.")
         userlog.error(traceback.format_exc())
         raise
+    if artifact is not None:
+        _save_template_artifact(templatefile, artifact, template_tree)
+
+
+def build_template_artifact(templatefile, artifact):
+    """Precompile templatefile into a template tree artifact.
+
+    The artifact holds the fully indexed template tree, compiled matchers
+    and all, so load_all_templates can skip parsing. This replaces the
+    current graphics.template_tree.
+    """
+    global template_tree
+    template_tree = None
+    load_all_templates(templatefile)
+    _save_template_artifact(templatefile, artifact, template_tree)
+
 
+def _hash_templatefile(templatefile):
+    with open(templatefile, 'rb') as alltemplates:
+        return hashlib.sha256(alltemplates.read()).digest()
 
-# TODO Maybe replace graphics_to_apply with curr_dict?
-def _apply_graphics_to_file(graphics_to_apply, file, sourceroot, targetpath):
-    """ Writes merged raws belonging to a single file.
 
-    * graphics_to_apply is a collection of BoundNode trees formatted as { file:
-    {topleveltag:BoundNode}}. This is the format returned by
-    BoundNode.bind_graphics_tags.
-    * file is the name of the file to apply graphics to, without any
-    information about its parent directories.
-    * sourceroot is the path to the directory containing the source raw version
-    of 'file'.
+def _load_template_artifact(templatefile, artifact):
+    """Return the template tree stored in artifact, or None if there isn't
+    a usable one for the current templatefile."""
+    try:
+        with open(artifact, 'rb') as artifact_file:
+            magic, version, digest = _ARTIFACT_HEADER.unpack(
+                artifact_file.read(_ARTIFACT_HEADER.size))
+            if ((magic != _ARTIFACT_MAGIC or
+                 version != TEMPLATE_ARTIFACT_VERSION or
+                 digest != _hash_templatefile(templatefile))):
+                userlog.info("Template artifact %s is out of date.", artifact)
+                return None
+            return pickle.load(artifact_file)
+    except FileNotFoundError:
+        return None
+    except (OSError, struct.error, pickle.UnpicklingError, EOFError,
+            AttributeError, ImportError):
+        userlog.warning("Could not load template artifact %s", artifact)
+        userlog.warning(traceback.format_exc())
+        return None
+
+
+def _save_template_artifact(templatefile, artifact, tree):
+    header = _ARTIFACT_HEADER.pack(_ARTIFACT_MAGIC, TEMPLATE_ARTIFACT_VERSION,
+                                   _hash_templatefile(templatefile))
+    temp_path = artifact + '.tmp'
+    try:
+        directory = os.path.dirname(artifact)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(temp_path, 'wb') as artifact_file:
+            artifact_file.write(header)
+            pickle.dump(tree, artifact_file, pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, artifact)
+        userlog.info("Template artifact written to %s .", artifact)
+    except OSError:
+        userlog.warning("Could not write template artifact %s", artifact)
+        userlog.warning(traceback.format_exc())
+
+
+def _build_all_dispatch(template_node):
+    """Build the get_child dispatch index of template_node and all of its
+    descendants."""
+    template_node.build_dispatch()
+    for child in template_node._children.values():
+        _build_all_dispatch(child)
+
+
+def _write_edited_file(edit_script, source, targetpath, output):
+    """Write a raw file with an edit script applied to it.
+
+    * edit_script is the file's tuple of Edits, as returned by
+    BoundNode.compile_edit_script.
+    * source is the contents of the target raw source file the script was
+    compiled from, as bytes.
     * targetpath is the path to the output file, with the name of the file
     included.
+    * output is what to write it to, as for write_modified_raws.
 
-    For each line in the raw source file, the function searches BoundNode for a
-    matching tag for each tag. If the tag is found, its contents are replaced
-    in the line with a merged version from the appropriate BoundNode. Then the
-    line - modified or unmodified - is written out to the output file.
+    This is a single forward pass over the source: everything outside the
+    edited tags is copied over unchanged, line endings included. Nothing in
+    edit_script is changed, so the same script can be written any number of
+    times.
     """
-    userlog.info("Merging graphics into %s ...", file)
-    curr_dict = graphics_to_apply[file]
-    curr_node = None
-    targetfile = open(targetpath, 'wt', encoding='cp437')
-    sourcefile = open(os.path.join(sourceroot, file), 'rt', encoding='cp437')
-    linecount = 0
-    tags_to_reset_addl = []
-    for line in sourcefile:
-        linecount = linecount + 1
-        modified_line = parsing.escape_problematic_literals(line)
-        additional = []
-        for tag in parsing.tags(line):
-            matching_node = None
-            if tag in curr_dict.keys():
-                matching_node = curr_dict[tag]
-            elif curr_node is not None:
-                matching_node = curr_node.find_match(tag)
-            if matching_node is not None:
-                curr_node = matching_node
-                matching_node.pop_self()
-                if matching_node.is_there_a_difference():
-                    merged_tag = matching_node.get_merged()
-                    if merged_tag is not None:
-                        replacement = matching_node.get_merged()
-                        userlog.debug("Replacing %s with %s at line %i.", tag,
-                                      replacement, linecount)
-                        modified_line = modified_line.replace(tag, replacement)
-                    else:
-                        userlog.debug("Removing tag %s at line %i.", tag,
-                                      linecount)
-                        to_remove = "[" + tag + "]"
-                        modified_line = modified_line.replace(to_remove, "")
-                    # modified_line = modified_line[:-1] + " (BAMM)\n"
-                additional.extend(matching_node.pop_addl())
-                tags_to_reset_addl.append(matching_node)
-            elif curr_node is not None:
-                problem_parent = curr_node.find_targetsonly_owner(tag)
-                if ((problem_parent is not None and
-                     problem_parent._targets_only[tag].has_graphics_info())):
-                    modderslog.info("Object missing graphics information in %s : %s",
-                                    targetpath, tag)
-                    # Targets without matching graphics
-                    modified_line = "No tag corresponding to (" + tag + \
-                        ") was found in graphics source. -BAMM\n" + modified_line
-
-        targetfile.writelines(modified_line)
-        for tag_node in additional:
-            linecount = linecount + 1
-            userlog.debug("Adding tag %s at line %i.", tag_node._tag,
-                          linecount)
-            line_to_write = "[" + tag_node._tag + "]\n"
-            targetfile.writelines(line_to_write)
-
-    targetfile.flush()
-    userlog.info("Finished outputting %s .", file)
-    targetfile.close()
-    sourcefile.close()
-# Resetting the additional tags for another
-    for node in tags_to_reset_addl:
-        node.reset_addl()
-
-
-def write_modified_raws(graphics_to_apply, raws_sourcedir, outputdir):
+    text = _apply_splices(source, _edit_splices(edit_script, source,
+                                                targetpath))
+    # The whole file is written in one go.
+    output.write(targetpath, text.encode('cp437'))
+    userlog.info("Finished outputting %s .", os.path.basename(targetpath))
+
+
+def _edit_splices(edit_script, source, targetpath):
+    """Turn edit_script into the exact text changes it makes to source, a
+    cp437-encoded raw file.
+
+    * targetpath is where the result is going, for the missing-graphics
+    report in the modders' log.
+
+    Returns a list of (start, end, text) splices in file order, each
+    replacing source[start:end] with text. Missing-graphics warnings are
+    inserted at the start of the line they belong to, and additional tags
+    at its end, each on their own line with the line's own line ending.
+    A line here runs from the line a tag starts on to the end of the line
+    the last tag on it ends on.
+    """
+    trace = userlog.isEnabledFor(config.TRACE_LEVEL)
+    splices = []
+    # The line the edits are on runs from line_start to line_end. Its
+    # splices start at splices[line_first].
+    line_start = 0
+    line_end = 0
+    line_first = 0
+    missing = []
+    additional = []
+    for edit in edit_script:
+        if edit.offset >= line_end:
+            _end_line(splices, source, line_start, line_end, line_first,
+                      missing, additional)
+            missing, additional = [], []
+            line_start = source.rfind(b'\n', 0, edit.offset) + 1
+            line_first = len(splices)
+        line_end = source.find(b'\n', edit.end)
+        line_end = len(source) if line_end == -1 else line_end + 1
+        if edit.replacement is not None:
+            splices.append((edit.offset, edit.end, edit.replacement))
+        for tag in edit.missing:
+            modderslog.info("Object missing graphics information in %s : %s",
+                            targetpath, tag)
+        missing.extend(edit.missing)
+        if trace:
+            for tag in edit.additional:
+                userlog.log(config.TRACE_LEVEL, "Adding tag %s.", tag)
+        additional.extend(edit.additional)
+    _end_line(splices, source, line_start, line_end, line_first, missing,
+              additional)
+    return splices
+
+
+def _end_line(splices, source, line_start, line_end, line_first, missing,
+              additional):
+    """Add the warning and additional tag splices of one line to splices.
+
+    * missing are the tags on the line which are missing graphics. A warning
+    for each goes on its own line before the line, latest first.
+    * additional is a list of tags to put on their own lines after it.
+    """
+    newline = "\r\n" if source[line_end - 2:line_end] == b'\r\n' else "\n"
+    if missing:
+        # Targets without matching graphics
+        splices.insert(line_first, (line_start, line_start, "".join(
+            "No tag corresponding to (" + tag +
+            ") was found in graphics source. -BAMM" + newline
+            for tag in reversed(missing))))
+    if additional:
+        splices.append((line_end, line_end, "".join(
+            "[" + tag + "]" + newline for tag in additional)))
+
+
+def _apply_splices(source, splices):
+    """Return the text of source, a cp437-encoded raw file, with splices, a
+    list of (start, end, text) in file order, applied to it."""
+    parts = []
+    pos = 0
+    for start, end, text in splices:
+        parts.append(source[pos:start].decode('cp437'))
+        parts.append(text)
+        pos = end
+    parts.append(source[pos:].decode('cp437'))
+    return "".join(parts)
+
+
+def write_modified_raws(graphics_to_apply, raws_sourcedir, outputdir,
+                        only=None, jobs=1, overrides=None, edit_scripts=None):
     """Write the full modified raws to the raw output directory.
 
     graphics_to_apply is a dict of type string:dict{string:BoundNode}. The top-
-    level string keys are filenames. Each filename's value is a dict
-    representing the top-level, relevant tags in the target raw file of that
-    name. The inner key is the full tag (without brackets), and the BoundNode
-    is the top node of the tree that that tag begins.
+    level string keys are the paths of target raw files, relative to
+    raws_sourcedir. Each one's value is a dict representing the top-level,
+    relevant tags in that file. The inner key is the full tag (without
+    brackets), and the BoundNode is the top node of the tree that that tag
+    begins.
 
     Unless you have way too much time on your hands, I recommend you generate
     graphics_to_apply using the bind_graphics_to_targets function.
 
-    The actual writing is done in this way: first, the function walks the
-    target raw source directory structure, and duplicates it in the raw output
-    directory. Then it walks the target raw source files, looking for each
-    filename in graphics_to_apply's keyset, or one of the properties
-    graphics_overwrite or graphics_ignore.
-        * If it finds the filename in graphics_overwrite, it copies the file
-        directly from the corresponding place in the graphics source directory.
-        * If it finds the filename in graphics_ignore, or doesn't find the
-        filename at all, it copies the file directly from the corresponding
-        place in the target raw source directory.
-        * If it finds the filename in graphics_to_apply's keyset, it opens the
-        file in the target raw source directory, creates and opens a
-        corresponding file in the raw output directory, and walks through the
-        target raw source file a line at a time, constructing the modified
-        file.
+    raws_sourcedir is the target raw source directory, or a RawTreeIndex of
+    it (see rawtree.py), which saves walking it again.
+
+    outputdir is the raw output directory. It can also be an OutputArchive
+    (see archive.py), to write the files into an archive instead.
+
+    The actual writing is done in this way: first, the function duplicates
+    the target raw source directory structure in the raw output directory.
+    Then it goes through the target raw source files, looking for each file
+    in overrides or graphics_to_apply's keyset, or among the files the
+    property graphics_ignore matches.
+        * If it finds the file in overrides, it copies the file directly from
+        the corresponding place in the graphics source directory.
+        * If it finds the file in graphics_ignore, or doesn't find the file
+        at all, it copies the file directly from the corresponding place in
+        the target raw source directory.
+        * If it finds the file in graphics_to_apply's keyset, it compiles
+        an edit script for the file in the target raw source directory (see
+        BoundNode.compile_edit_script), and writes the source file with the
+        script applied to the corresponding file in the raw output directory.
+
+    only is an optional set of paths, relative to raws_sourcedir, of the files
+    to write. If it's given, all other files are left as they are in the
+    output directory.
+
+    overrides is an optional dict of the graphics source files to copy over
+    the target's, as returned by find_graphics_overrides. Those the target
+    doesn't have at all, such as extra art, are copied to the output too.
+
+    edit_scripts is an optional dict of edit scripts already compiled in
+    worker processes, as returned by compile_edit_scripts_in_pool. The files
+    in it are merged with those scripts, as if they were in
+    graphics_to_apply.
+
+    jobs is the number of threads to write files in. The whole output
+    directory structure is created before any files are written, and log
+    messages come out in the same order whatever the number of jobs.
     """
 
-    properties = config.properties
+    target_tree = _target_tree(raws_sourcedir)
     userlog.info("Writing modified raws...")
-    os.makedirs(outputdir, exist_ok=True)
-    for root, dirs, files in os.walk(raws_sourcedir):
-        # Create directories so we don't have any issues later on
-        for _dir in dirs:
-            targetdir = os.path.join(root, _dir)
-            targetdir = outputdir + targetdir[len(raws_sourcedir):]
-            if not os.path.exists(targetdir):
-                userlog.info("Creating output directory %s", _dir)
-                os.makedirs(targetdir, exist_ok=True)
-        for file in files:
-            targetpath = os.path.join(root, file)
-            targetpath = outputdir + targetpath[len(raws_sourcedir):]
-            if ((parsing.path_compatible(
-                    targetpath, properties[config.GRAPHICS_IGNORE_LIST][1:]) or
-                 file not in graphics_to_apply.keys())):
-                userlog.info("Copying %s from target source...", file)
-                targetpath = shutil.copyfile(os.path.join(root, file),
-                                             targetpath)
-                userlog.info("%s copied.", file)
-            # TODO Need to implement graphics overwrites
-#             elif parsing.path_compatible(targetpath,
-#                                          properties[config.GRAPHICS_OVERWRITE_LIST][1:]
-#                                          ):
-#                 pass
-            else:
-                _apply_graphics_to_file(graphics_to_apply, file, root,
-                                        targetpath)
+    if isinstance(outputdir, str):
+        output = _DirectoryOutput(outputdir)
+    else:
+        output = outputdir
+    if overrides is None:
+        overrides = {}
+    if edit_scripts is None:
+        edit_scripts = {}
+    # Create directories so we don't have any issues later on
+    for reldir in target_tree.dirs:
+        output.add_directory(os.path.join(output.root, reldir))
+    to_write = []
+    for relpath, indexed in target_tree.files.items():
+        if only is not None and relpath not in only:
+            continue
+        if relpath in overrides:
+            sourcepath, action = overrides[relpath], _COPY_GRAPHICS
+        elif ((indexed.kind == rawtree.RAW and
+               (relpath in edit_scripts or
+                relpath in graphics_to_apply.keys()))):
+            sourcepath, action = indexed.path, _MERGE
+        else:
+            sourcepath, action = indexed.path, _COPY_TARGET
+        to_write.append((graphics_to_apply, edit_scripts, output, relpath,
+                         sourcepath, os.path.join(output.root, relpath),
+                         action))
+    # Graphics source files which the target doesn't have at all
+    extra_files = sorted(relpath for relpath
+                         in overrides.keys() - target_tree.files.keys()
+                         if only is None or relpath in only)
+    target_dirs = set(target_tree.dirs)
+    extra_dirs = set()
+    for relpath in extra_files:
+        reldir = os.path.dirname(relpath)
+        while reldir and reldir not in target_dirs:
+            extra_dirs.add(reldir)
+            reldir = os.path.dirname(reldir)
+    for reldir in sorted(extra_dirs):
+        output.add_directory(os.path.join(output.root, reldir))
+    for relpath in extra_files:
+        to_write.append((graphics_to_apply, edit_scripts, output, relpath,
+                         overrides[relpath],
+                         os.path.join(output.root, relpath), _COPY_GRAPHICS))
+
+    if jobs > 1 and len(to_write) > 1:
+        _call_with_ordered_logs(_write_output_file, to_write, jobs)
+    else:
+        for args in to_write:
+            _write_output_file(*args)
 
     userlog.info("All files written.")
 
 
-# TODO implement
-# TODO docstring (when method is finished)
-def find_graphics_overrides(graphics_directory, graphics_overwrites):
-    to_return = []
-    userlog.info("Locating graphics override files")
-    for root, dirs, files in os.walk(graphics_directory):
-        for file in files:
-            filepath = os.path.join(root, file)
-            if parsing.path_compatible(filepath, graphics_overwrites):
-                to_return.append(filepath)
-    return to_return
+def write_patch(graphics_to_apply, raws_sourcedir, patchpath, only=None,
+                edit_scripts=None):
+    """Write the changes merging would make to the target raws to a patch
+    file, instead of writing out the whole modified raw tree.
+
+    graphics_to_apply, raws_sourcedir, only and edit_scripts are as for
+    write_modified_raws. patchpath is the path of the patch file to write.
+
+    The patch only covers files which merging would actually change. It is
+    a JSON file holding a list of files, each with:
+        * path: the file's path relative to raws_sourcedir, with '/' as the
+        separator.
+        * digest: a digest of the file's contents, so the patch is only ever
+        applied to the file it was made from.
+        * splices: a list of [start, end, text] changes, in file order, each
+        replacing the text from offset start to end with text.
+
+    Applying the patch to the target raws with apply_patch gives the same
+    files write_modified_raws would have written.
+    """
+    target_tree = _target_tree(raws_sourcedir)
+    userlog.info("Writing patch...")
+    if edit_scripts is None:
+        edit_scripts = {}
+    patched = []
+    for relpath, indexed in target_tree.files.items():
+        if ((only is not None and relpath not in only) or
+                indexed.kind != rawtree.RAW or
+                (relpath not in edit_scripts and
+                 relpath not in graphics_to_apply.keys())):
+            continue
+        userlog.info("Merging graphics into %s ...", relpath)
+        with open(indexed.path, 'rb') as sourcefile:
+            source = sourcefile.read()
+        edit_script = _file_edit_script(graphics_to_apply, edit_scripts,
+                                        relpath, indexed.path, source)
+        splices = _edit_splices(edit_script, source, indexed.path)
+        if splices:
+            patched.append({'path': relpath.replace(os.sep, '/'),
+                            'digest': _digest_source(source),
+                            'splices': splices})
+
+    temp_path = patchpath + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as patchfile:
+        json.dump({'format': _PATCH_FORMAT,
+                   'version': PATCH_FORMAT_VERSION,
+                   'files': patched}, patchfile)
+    os.replace(temp_path, patchpath)
+    userlog.info("Patch for %i files written to %s .", len(patched),
+                 patchpath)
+
+
+def apply_patch(patchpath, directory):
+    """Apply a patch written by write_patch to the raw files in directory,
+    in place.
+
+    A file is only patched if its contents are exactly those the patch was
+    made from. Others, such as files the patch has already been applied to,
+    are logged and left alone, as are entries whose paths lead outside
+    directory.
+
+    Returns a list of the paths, relative to directory, which couldn't be
+    patched.
+    """
+    userlog.info("Applying patch %s to %s ...", patchpath, directory)
+    try:
+        with open(patchpath, 'r', encoding='utf-8') as patchfile:
+            patch = json.load(patchfile)
+        if ((patch.get('format') != _PATCH_FORMAT or
+             patch.get('version') != PATCH_FORMAT_VERSION)):
+            raise ValueError(patchpath + " is not a patch this version of " +
+                             "BAMM can apply.")
+    except:
+        userlog.error("Exception in loading patch.")
+        userlog.error(traceback.format_exc())
+        raise
+    failed = []
+    root = os.path.abspath(directory)
+    for entry in patch['files']:
+        path = os.path.normpath(os.path.join(root,
+                                             *entry['path'].split('/')))
+        try:
+            inside = os.path.commonpath([root, path]) == root
+        except ValueError:
+            # Paths on different drives.
+            inside = False
+        if not inside:
+            userlog.error("%s is outside %s ; skipping it.", entry['path'],
+                          directory)
+            failed.append(entry['path'])
+            continue
+        try:
+            with open(path, 'rb') as sourcefile:
+                source = sourcefile.read()
+        except OSError:
+            source = None
+        if source is None or _digest_source(source) != entry['digest']:
+            userlog.error("%s is missing or isn't the file the patch was " +
+                          "made from; skipping it.", entry['path'])
+            failed.append(entry['path'])
+            continue
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as targetfile:
+            targetfile.write(_apply_splices(source, entry['splices']
+                                            ).encode('cp437'))
+        os.replace(temp_path, path)
+        userlog.info("Patched %s .", entry['path'])
+    userlog.info("Patch applied to %i of %i files.",
+                 len(patch['files']) - len(failed), len(patch['files']))
+    return failed
+
+
+def _digest_source(source):
+    return hashlib.blake2b(source, digest_size=16).hexdigest()
+
+
+def _write_output_file(graphics_to_apply, edit_scripts, output, relpath,
+                       sourcepath, targetpath, action):
+    """Write the output file at targetpath from the file at sourcepath, by
+    merging or copying as write_modified_raws describes.
+
+    * relpath is the file's path relative to the output directory.
+    * action is _MERGE, _COPY_TARGET or _COPY_GRAPHICS.
+    """
+    if action == _COPY_GRAPHICS:
+        userlog.info("Copying %s from graphics source...", relpath)
+        output.copy(sourcepath, targetpath)
+        userlog.info("%s copied.", relpath)
+    elif action == _COPY_TARGET:
+        userlog.info("Copying %s from target source...", relpath)
+        output.copy(sourcepath, targetpath)
+        userlog.info("%s copied.", relpath)
+    else:
+        userlog.info("Merging graphics into %s ...", relpath)
+        # The source is read once, and used for both the script and the
+        # output.
+        with open(sourcepath, 'rb') as sourcefile:
+            source = sourcefile.read()
+        _write_edited_file(
+            _file_edit_script(graphics_to_apply, edit_scripts, relpath,
+                              sourcepath, source),
+            source, targetpath, output)
+
+
+def _file_edit_script(graphics_to_apply, edit_scripts, relpath, sourcepath,
+                      source):
+    """Return the edit script of the target raw file at sourcepath.
+
+    * source is the file's contents, as bytes.
+
+    A script already compiled in edit_scripts is used if there is one, so
+    long as the file hasn't changed since; otherwise it's compiled from
+    graphics_to_apply. Both are as for write_modified_raws.
+    """
+    if relpath in edit_scripts:
+        digest, edit_script = edit_scripts[relpath]
+        if digest != _digest_source(source):
+            # The script's offsets are into contents which are gone.
+            raise OSError(sourcepath + " changed while it was being merged.")
+        return edit_script
+    return BoundNode.compile_edit_script(graphics_to_apply[relpath],
+                                         sourcepath, source)
+
+
+def _target_tree(raws_sourcedir):
+    """Return raws_sourcedir as a RawTreeIndex, indexing it if it's a
+    directory."""
+    if isinstance(raws_sourcedir, rawtree.RawTreeIndex):
+        return raws_sourcedir
+    return rawtree.RawTreeIndex(
+        raws_sourcedir,
+        parsing.PathMatcher.from_property(config.GRAPHICS_IGNORE_LIST))
+
+
+class _DirectoryOutput():
+    """Writes output files to the filesystem, for write_modified_raws. This
+    is the plain counterpart to archive.OutputArchive.
+
+    Members:
+        * root is the output directory. It is created if necessary.
+    """
+
+    def __init__(self, directory):
+        self.root = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def add_directory(self, path):
+        if not os.path.exists(path):
+            userlog.info("Creating output directory %s",
+                         os.path.basename(path))
+            os.makedirs(path, exist_ok=True)
+
+    def write(self, path, data):
+        with open(path, 'wb') as targetfile:
+            targetfile.write(data)
+
+    def copy(self, sourcepath, path):
+        _copy_file(sourcepath, path)
+
+
+def _copy_file(sourcepath, targetpath):
+    """Copy the contents of the file at sourcepath to targetpath.
+
+    Where os.copy_file_range is available, the copy is left to the kernel,
+    which can share the data or copy it server-side instead of passing it
+    through this process. Otherwise, or if the filesystem won't do it,
+    shutil.copyfile is used, which uses sendfile or the platform's own fast
+    copy where it can.
+    """
+    if hasattr(os, 'copy_file_range'):
+        try:
+            with open(sourcepath, 'rb') as sourcefile, \
+                    open(targetpath, 'wb') as targetfile:
+                remaining = os.fstat(sourcefile.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(sourcefile.fileno(),
+                                                targetfile.fileno(),
+                                                remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+            if remaining == 0:
+                return
+        except OSError as error:
+            if error.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                                   errno.EOPNOTSUPP, errno.EPERM):
+                raise
+    shutil.copyfile(sourcepath, targetpath)
+
+
+class _LogHolder(logging.Filter):
+    """A logging filter which holds back the records logged by any thread
+    that is running a call through hold(), instead of letting them through.
+    """
+
+    def __init__(self):
+        logging.Filter.__init__(self)
+        self._local = threading.local()
+
+    def filter(self, record):
+        held = getattr(self._local, 'held', None)
+        if held is None:
+            return True
+        held.append(record)
+        return False
+
+    def hold(self, function, args):
+        """Call function(*args), holding back its log records.
+
+        Returns a tuple of the held records and the exception the call
+        raised, or None if it didn't.
+        """
+        self._local.held = []
+        error = None
+        try:
+            function(*args)
+        except Exception as call_error:
+            error = call_error
+        held = self._local.held
+        self._local.held = None
+        return held, error
+
+
+_log_holder = _LogHolder()
+
+
+def _call_with_ordered_logs(function, calls, jobs):
+    """Call function(*args) for each args in calls, in a pool of jobs
+    threads.
+
+    The messages each call logs to userlog and modderslog are held back
+    until it's done, then logged in the order of calls, so the logs come out
+    the same as if the calls had been made one after another. If a call
+    raises an exception, it's re-raised once that call's messages are out.
+    """
+    userlog.addFilter(_log_holder)
+    modderslog.addFilter(_log_holder)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+            for held, error in pool.map(
+                    lambda args: _log_holder.hold(function, args), calls):
+                for record in held:
+                    logging.getLogger(record.name).handle(record)
+                if error is not None:
+                    raise error
+    finally:
+        userlog.removeFilter(_log_holder)
+        modderslog.removeFilter(_log_holder)
+
+
+def write_condensed_raws(node_collection, outputdir, overrides=None):
+    """Write condensed, graphics-only versions of the raw files in a
+    collection.
+
+    * node_collection is a dict of type string:dict{string:TagNode}, as
+    returned by TagNode.walk_rawfiles_into_tagnode_collection.
+    * outputdir is the directory to write them to. Each file is written to
+    the same path under it as it has in the collection.
+    * overrides is an optional dict of the graphics source files which
+    overwrite the target's, as returned by find_graphics_overrides. They are
+    copied to the same paths under outputdir unchanged, so the condensed
+    raws can stand in for the whole graphics source.
+
+    Each file keeps only the tags in the collection, which are the ones that
+    match a template, under an [OBJECT:...] header for each type of object.
+    Every other tag is left out, and so are files with none. Objects and
+    sub-objects are kept even if they have no graphics tags, since they still
+    bind to the target's, and decide what happens to the target's tags under
+    them. Loading the result as a graphics source gives the same collection
+    as loading the original files.
+    """
+    userlog.info("Writing condensed raws to %s ...", outputdir)
+    os.makedirs(outputdir, exist_ok=True)
+    written = 0
+    for relpath, top_level_nodes in node_collection.items():
+        lines = []
+        object_type = None
+        for node in top_level_nodes.values():
+            node_type = _OBJECT_TYPES.get(node._tag.split(':')[0])
+            if node_type is not None and node_type != object_type:
+                object_type = node_type
+                lines.append("")
+                lines.append("[OBJECT:" + object_type + "]")
+                lines.append("")
+            _condense_node(node, 0, lines)
+        if lines:
+            # Raw files start with their own name.
+            lines.insert(0, os.path.splitext(os.path.basename(relpath))[0])
+            lines.append("")
+            targetpath = os.path.join(outputdir, relpath)
+            os.makedirs(os.path.dirname(targetpath), exist_ok=True)
+            with open(targetpath, 'wb') as rawfile:
+                rawfile.write("\r\n".join(lines).encode('cp437'))
+            written += 1
+    userlog.info("%i condensed raw files written.", written)
+    if overrides:
+        for relpath, sourcepath in overrides.items():
+            targetpath = os.path.join(outputdir, relpath)
+            os.makedirs(os.path.dirname(targetpath), exist_ok=True)
+            _copy_file(sourcepath, targetpath)
+        userlog.info("%i graphics source files copied as they are.",
+                     len(overrides))
+
+
+def _condense_node(node, depth, lines):
+    """Add node's tag and its descendants to lines, indented by depth."""
+    lines.append("\t" * depth + "[" + node._tag + "]")
+    for child in node._pat_children.values():
+        _condense_node(child, depth + 1, lines)
+
+
+def find_graphics_overrides(graphics_trees):
+    """Return the graphics source files which should be copied over the
+    target's, as a dict mapping path relative to the source directory to the
+    path of the file to copy.
+
+    * graphics_trees is a list of RawTreeIndexes of the graphics source
+    directories, indexed with the graphics_overwrite matcher.
+
+    Where more than one source directory has the file, the last one's is used.
+    """
+    overrides = {}
+    for graphics_tree in graphics_trees:
+        for relpath in graphics_tree.relpaths(rawtree.OVERWRITE):
+            overrides[relpath] = graphics_tree.files[relpath].path
+    userlog.info("%i graphics source files will overwrite the target's.",
+                 len(overrides))
+    return overrides
 
 
 class TreeNode():
@@ -219,17 +778,25 @@ class TreeNode():
         * self._tag = The string that this node represents. This should be
         overridden and re-defined by subclasses.
         * self._children = A dict of type string:TreeNode, where the key is the
-        child's ._tag property.
+        child's ._tag property. Until the first child is added, this is the
+        shared, read-only _EMPTY mapping.
+
+    Nodes use __slots__ instead of per-instance dicts, since a big modpack
+    means hundreds of thousands of them.
     """
 
+    __slots__ = ('_parent', '_children', '_tag')
+
     # TODO docstring
     def __init__(self, parent=None):
         self._parent = parent
-        self._children = {}
+        self._children = _EMPTY
         self._tag = None
 
     # TODO docstring
     def add_child(self, child_node):
+        if self._children is _EMPTY:
+            self._children = {}
         self._children[child_node._tag] = child_node
 
     # TODO docstring
@@ -293,14 +860,22 @@ class TemplateNode(TreeNode):
     * _childref is the same as _children, but indexed by the first token (the
     "value") of the child's _tag, instead of the full _tag. For convenience/
     performance only.
+    * _dispatch and _open_dispatch index the children by first token and
+    token count, for get_child. They are built by build_dispatch, and reset
+    whenever a child is added.
     * _parent is the TemplateNode representing the type of tag that the type of
     tag this TemplateNode represents can be a child of.
     * _is_graphics_tag is a boolean that lets us know if this tag is a graphics
     tag, as opposed to a template included because it can have graphics
     children. This is necessary because some graphics tags are composed of only
     a single literal token.
+    * _matcher is the TemplateMatcher compiled from _tag when the node is
+    created, which get_template_match uses.
     """
 
+    __slots__ = ('_is_graphics_tag', '_childref', '_dispatch',
+                 '_open_dispatch', '_matcher')
+
     # string does not contain the character '|'.
     def __init__(self, parent, string=""):
         """ Initializes a TemplateNode
@@ -315,9 +890,13 @@ class TemplateNode(TreeNode):
         parent.
         """
         TreeNode.__init__(self, parent)
+        self._children = {}
         self._is_graphics_tag = False
         self._childref = {}
+        self._dispatch = None
+        self._open_dispatch = None
         self._tag = None
+        self._matcher = None
         global template_tree
         if parent is None:
             self._parent = None
@@ -329,6 +908,7 @@ class TemplateNode(TreeNode):
                 self._parent = parent
 
             self._tag = string
+            self._matcher = TemplateMatcher(string)
 
             parent.add_child(self)
 
@@ -347,131 +927,117 @@ class TemplateNode(TreeNode):
             if first_token not in self._childref.keys():
                 self._childref[first_token] = []
             self._childref[first_token].append(node)
+            self._dispatch = None
             return node
 
-    # TODO docstring
     def get_child(self, tag):
+        """Return the child TemplateNode that tag matches, or None.
+
+        A child whose whole template is tag wins outright. Otherwise the
+        candidates come from the dispatch index (see build_dispatch), most
+        specific first, and the first one whose template matches tag wins.
+        """
         if tag in self._children.keys():
             return self._children[tag]
+        if self._dispatch is None:
+            self.build_dispatch()
+        tokens = tag.split(':')
+        entry = self._dispatch.get((tokens[0], len(tokens)))
+        if entry is None:
+            candidates = self._open_dispatch.get(tokens[0], ())
         else:
-            return_possibilities = []
-            first_token = tag.split(':')[0]
-            if first_token in self._childref:
-                for child in self._childref[first_token]:
-                    return_node = child.get_template_match(tag)
-                    if return_node is not None:
-                        return_possibilities.append((child, return_node))
-                if len(return_possibilities) == 1:
-                    return return_possibilities[0][0]
-                elif len(return_possibilities) == 0:
-                    return None
+            position, table, candidates = entry
+            if position is not None:
+                candidates = table.get(tokens[position], candidates)
+        for child in candidates:
+            if child.get_template_match(tag) is not None:
+                return child
+        return None
+
+    def build_dispatch(self):
+        """Index this node's children for get_child.
+
+        Children are keyed by their first token plus the number of tokens a
+        tag needs to match them. Each key maps to a tuple
+        (position, table, candidates), where candidates are the children
+        that could match, most specific (most literal tokens) first; ties
+        keep the order the templates were loaded in. When several children
+        share a key, position is a token position where some of them have
+        literals, such as the ALL and NONE variants of GROWTH_PRINT, and
+        table maps each of those literals to just the candidates that could
+        match it. Otherwise position and table are None.
+
+        Children with unbounded ranges, like ?(1,), can match any number of
+        tokens: they're added under every key for their first token, and
+        also kept in _open_dispatch for token counts no other child has.
+        """
+        self._dispatch = {}
+        self._open_dispatch = {}
+        for first_token, children in self._childref.items():
+            ranked = sorted(children,
+                            key=lambda child: -child._matcher.specificity)
+            counts = set()
+            open_children = []
+            for child in ranked:
+                low, high = child._matcher.length_range()
+                if high is None:
+                    open_children.append(child)
                 else:
-                    # TODO error handling
-                    userlog.debug("Found more than one matching child. \
-                                  Matching children are:")
-                    for poss in return_possibilities:
-                        userlog.debug(poss[1])
-                    possible_tags = [a[1] for a in return_possibilities]
-                    winner = TemplateNode._get_best_match(possible_tags)
-                    return return_possibilities[possible_tags.index(winner)][0]
-            else:
-                return None
+                    counts.update(range(low, high + 1))
+            if open_children:
+                self._open_dispatch[first_token] = tuple(open_children)
+            for count in counts:
+                candidates = [child for child in ranked
+                              if child._matcher.accepts_length(count)]
+                self._dispatch[(first_token, count)] = \
+                    TemplateNode._switch_on_literal(candidates, count)
+
+    @staticmethod
+    def _switch_on_literal(candidates, count):
+        """Return the (position, table, candidates) dispatch entry for
+        candidates, which all accept tags of count tokens."""
+        if len(candidates) < 2:
+            return (None, None, tuple(candidates))
+        layouts = [child._matcher.layout_for_length(count)
+                   for child in candidates]
+        if None in layouts:
+            return (None, None, tuple(candidates))
+        best_position = None
+        best_literals = set()
+        for position in range(1, count):
+            literals = set(layout[position] for layout in layouts
+                           if layout[position] not in ('?', '$', '&'))
+            if len(literals) > len(best_literals):
+                best_position = position
+                best_literals = literals
+        if best_position is None:
+            return (None, None, tuple(candidates))
+        table = {}
+        for literal in best_literals:
+            table[literal] = tuple(child for child, layout
+                                   in zip(candidates, layouts)
+                                   if layout[best_position] in
+                                   (literal, '?', '$', '&'))
+        default = tuple(child for child, layout in zip(candidates, layouts)
+                        if layout[best_position] in ('?', '$', '&'))
+        return (best_position, table, default)
 
-    # This tells if a single tag matches a single tag; that is, it assumes
-    # we've got one element of the |-separated list
-    # TODO docstring
     def get_template_match(self, tag_to_compare):
+        """Return the token layout of tag_to_compare under this template, or
+        None if it doesn't match.
+
+        This tells if a single tag matches a single tag; that is, it assumes
+        we've got one element of the |-separated list. The layout is a tuple
+        with one entry per token of the tag: the template's literal where the
+        template has a literal, or the variable character ('?', '$' or '&')
+        where it has a variable or variable range.
+        """
         if self._tag is None:
             return None
-        template_token_bag = []
-        template_token_bag.append(self._tag.split(':'))
-        candidate_tokens = tag_to_compare.split(':')
-
-        ii = 0
-        while (len(template_token_bag) > 0 and
-               (ii < len(candidate_tokens) or
-                ii < len(template_token_bag[0]))):
-            good_to_go = False
-            for var in template_token_bag:
-                if ii < len(candidate_tokens) and ii >= len(var):
-                    template_token_bag.remove(var)
-                elif ii >= len(var) and len(var) == len(candidate_tokens):
-                    good_to_go = True
-                elif (ii >= len(candidate_tokens) and
-                      (ii >= len(var) or
-                       (ii < len(var) and '(0,' not in var[ii]))):
-                    template_token_bag.remove(var)
-                elif ('&' == var[ii] or '?' == var[ii] or '$' == var[ii] or
-                      (ii < len(candidate_tokens) and
-                       var[ii] == candidate_tokens[ii])):
-                    # This case is an auto-pass
-                    good_to_go = True
-                else:
-                    if '&' in var[ii] or '?' in var[ii] or '$' in var[ii]:
-                        varii_type = var[ii][0]
-                        varii_range = var[ii][2:var[ii].index(')')].split(',')
-                        # If len(varii_range) == 1 then we have a range of
-                        # format (x,), indicating any number of :'s
-                        if len(varii_range[1]) == 0:
-                            varii_range[1] = len(candidate_tokens)-len(var) + 1
-                        # For every possible length (the +1 is because range is
-                        # exclusive-end and my notation is inclusive-end)
-                        for jj in range(int(varii_range[0]),
-                                        int(varii_range[1])+1):
-                            # Make a copy of var
-                            new_var = var[:]
-                            # Remove the range item
-                            del new_var[ii]
-                            # Replace it with (one of the possible lengths)
-                            # times the multiplied symbol
-                            # If jj is 0 the range item is just removed
-                            for kk in range(0, jj):
-                                new_var.insert(ii, varii_type)
-                            # Place the new variant in the token bag for
-                            # evaluation
-                            template_token_bag.append(new_var)
-                    # No counting, there is a new template_token_bag[ii]
-                    template_token_bag.remove(var)
-            if good_to_go:
-                ii += 1
-        for tag in template_token_bag:
-            if len(tag) != len(candidate_tokens):
-                template_token_bag.remove(tag)  # This isn't working properly?
-
-        if len(template_token_bag) == 0:
-            return None
-        elif len(template_token_bag) == 1:
-            return template_token_bag[0]
-        else:
-            # TODO error handling
-            highest_priority = TemplateNode._get_best_match(template_token_bag)
-            userlog.debug("More than one template matched.\nTag: %s Matches:",
-                          tag_to_compare)
-            for template in template_token_bag:
-                userlog.debug("\t%s", template)
-            userlog.debug("The highest-priority match is %s", highest_priority)
-            # Technically this does in fact have a matching template
-            return highest_priority
-
-    # TODO docstring
-    @staticmethod
-    def _get_best_match(template_tokens_bag):
-        if not template_tokens_bag:        # empty bag returns false
-            return None
-        elif len(template_tokens_bag) == 1:
-            return template_tokens_bag[0]
+        elif match_cache is None:
+            return self._matcher.match(tag_to_compare)
         else:
-            best_currently = template_tokens_bag[0]
-            best_tokens = 0
-            for tag in template_tokens_bag:
-                challenger_tokens = 0
-                for token in tag:
-                    if token != '?' and token != '&' and token != '$':
-                        challenger_tokens = challenger_tokens + 1
-                if challenger_tokens > best_tokens:
-                    best_currently = tag
-                    best_tokens = challenger_tokens
-            return best_currently
+            return match_cache.get_template_match(self, tag_to_compare)
 
     # TODO docstring
     def how_many_generations(self):
@@ -484,25 +1050,242 @@ class TemplateNode(TreeNode):
         return count
 
 
+class TemplateMatcher():
+    """A single template string, compiled for matching against tags.
+
+    The template is split into tokens once, up front (see TemplateNode for
+    the token syntax). Variable ranges whose length is fixed, like ?(3,3),
+    are expanded right away. That leaves at most a handful of flexible
+    ranges, like &(0,1) or ?(1,); every template in graphicstemplates.config
+    has no more than one. With a single flexible range, the tag's token count
+    alone says how long the range is, so a match is one pass over the
+    template's literals. Templates with several flexible ranges fall back to
+    a search which gives the earlier ranges as few tokens as possible.
+
+    Members:
+        * _segments is a list of (variable, minimum, maximum) tuples, one per
+        template token. variable is the token's literal, or the variable
+        character for variables and ranges. maximum is None for unbounded
+        ranges. Literals and plain variables have minimum = maximum = 1.
+        * _prefix and _suffix are the expanded layouts before and after the
+        single flexible range, if there is at most one. Without any flexible
+        range, _prefix is the whole layout and _flexible is None.
+        * _flexible is the (variable, minimum, maximum) of the single
+        flexible range, or None.
+        * _literals is a list of (position, literal) pairs, where position
+        counts from the start of the tag for the prefix and from the end of
+        the tag (as a negative index) for the suffix.
+        * _layouts caches the layout tuple for each tag length seen.
+        * specificity is the number of literal tokens in the template. When
+        a tag matches several templates, the most specific one wins.
+    """
+
+    _RANGE = re.compile(r'^([?$&])\((\d+),(\d*)\)$')
+
+    def __init__(self, template):
+        self._segments = []
+        for token in template.split(':'):
+            match = TemplateMatcher._RANGE.match(token)
+            if match is None:
+                self._segments.append((token, 1, 1))
+            else:
+                maximum = match.group(3)
+                self._segments.append((match.group(1), int(match.group(2)),
+                                       int(maximum) if maximum else None))
+        flexible = [ii for ii, (variable, minimum, maximum)
+                    in enumerate(self._segments) if minimum != maximum]
+        self._layouts = {}
+        self.specificity = len([variable for variable, minimum, maximum
+                                in self._segments
+                                if variable not in ('?', '$', '&')])
+        if len(flexible) > 1:
+            self._flexible = None
+            self._prefix = None
+            self._suffix = None
+            self._literals = None
+            return
+        split = flexible[0] if flexible else len(self._segments)
+        self._prefix = TemplateMatcher._expand(self._segments[:split])
+        self._suffix = TemplateMatcher._expand(self._segments[split+1:])
+        self._flexible = self._segments[split] if flexible else None
+        self._literals = []
+        for ii, token in enumerate(self._prefix):
+            if token not in ('?', '$', '&'):
+                self._literals.append((ii, token))
+        for ii, token in enumerate(self._suffix):
+            if token not in ('?', '$', '&'):
+                self._literals.append((ii - len(self._suffix), token))
+
+    @staticmethod
+    def _expand(segments):
+        """Return the layout of segments which all have fixed lengths."""
+        layout = []
+        for variable, minimum, maximum in segments:
+            layout.extend([variable] * minimum)
+        return tuple(layout)
+
+    def length_range(self):
+        """Return (fewest, most) tokens a matching tag can have. most is
+        None if there's no upper bound."""
+        low = 0
+        high = 0
+        for variable, minimum, maximum in self._segments:
+            low += minimum
+            if maximum is None or high is None:
+                high = None
+            else:
+                high += maximum
+        return (low, high)
+
+    def accepts_length(self, length):
+        """Return True if a tag with length tokens could match."""
+        low, high = self.length_range()
+        return low <= length and (high is None or length <= high)
+
+    def layout_for_length(self, length):
+        """Return the layout a matching tag of length tokens would have, or
+        None if there isn't exactly one such layout."""
+        if self._prefix is None or not self.accepts_length(length):
+            return None
+        return self._layout(length - len(self._prefix) - len(self._suffix))
+
+    def match(self, tag):
+        """Return the layout tuple of tag under this template, or None."""
+        tokens = tag.split(':')
+        if self._prefix is None:
+            return self._search(tokens)
+        count = len(tokens) - len(self._prefix) - len(self._suffix)
+        if self._flexible is None:
+            if count != 0:
+                return None
+        elif count < self._flexible[1] or (self._flexible[2] is not None and
+                                           count > self._flexible[2]):
+            return None
+        for position, literal in self._literals:
+            if tokens[position] != literal:
+                return None
+        return self._layout(count)
+
+    def _layout(self, count):
+        """Return the layout with count tokens in the flexible range."""
+        try:
+            return self._layouts[count]
+        except KeyError:
+            if self._flexible is None:
+                layout = self._prefix
+            else:
+                layout = (self._prefix + (self._flexible[0],) * count +
+                          self._suffix)
+            self._layouts[count] = layout
+            return layout
+
+    def _search(self, tokens):
+        """Match tokens against a template with several flexible ranges."""
+        def place(segment_index, token_index):
+            if segment_index == len(self._segments):
+                return [] if token_index == len(tokens) else None
+            variable, minimum, maximum = self._segments[segment_index]
+            if maximum is None:
+                maximum = len(tokens) - token_index
+            if minimum == 1 and maximum == 1 and variable not in ('?', '$',
+                                                                  '&'):
+                if ((token_index >= len(tokens) or
+                     tokens[token_index] != variable)):
+                    return None
+            for count in range(minimum, maximum + 1):
+                if token_index + count > len(tokens):
+                    break
+                rest = place(segment_index + 1, token_index + count)
+                if rest is not None:
+                    return [variable] * count + rest
+            return None
+        layout = place(0, 0)
+        return None if layout is None else tuple(layout)
+
+
+class MatchCache():
+    """A bounded cache of template match results.
+
+    Keys are (TemplateNode, tag string) pairs and values are what the
+    TemplateNode's matcher returned for the tag, None included. The same tag
+    gets matched against the same template several times over (to find its
+    template, its pattern, and again when merging), and many tags repeat
+    heavily across objects, e.g. COLOR:7:0:0.
+
+    When the cache is full, the oldest entry is dropped to make room.
+
+    Members:
+        * _max_size is the most entries the cache will hold.
+        * _results is the dict of cached results, oldest first.
+        * hits and misses count lookups that were or weren't cached, to help
+        size the cache.
+        * _lock serializes changes to _results, so files can be written from
+        several threads at once.
+    """
+
+    def __init__(self, max_size):
+        self._max_size = max_size
+        self._results = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_template_match(self, template, tag):
+        """Return template._matcher.match(tag), from the cache if possible."""
+        key = (template, tag)
+        try:
+            result = self._results[key]
+        except KeyError:
+            self.misses += 1
+            result = template._matcher.match(tag)
+            with self._lock:
+                if len(self._results) >= self._max_size:
+                    del self._results[next(iter(self._results))]
+                self._results[key] = result
+            return result
+        else:
+            self.hits += 1
+            return result
+
+
+def load_match_cache(max_size):
+    """Initialize graphics.match_cache to hold up to max_size results.
+
+    A max_size of 0 disables the cache.
+    """
+    global match_cache
+    if max_size > 0:
+        match_cache = MatchCache(max_size)
+    else:
+        match_cache = None
+
+
 # TODO docstring
 class TagNode(TreeNode):
 
+    __slots__ = ('_filename', '_template', '_pat_children', '_pattern')
+
     # TODO docstring
-    def __init__(self, filename, template, tag, parent=None):
+    def __init__(self, filename, template, tag, parent=None, pattern=None):
         TreeNode.__init__(self, parent)
-        self._tag = tag
+        # Tags like COLOR:7:0:0 repeat all over the raws, so share them.
+        self._tag = sys.intern(tag)
         self._filename = filename
         self._template = template
-        self._children = {}
-        self._pat_children = {}
+        self._pat_children = _EMPTY
         self._pattern = None
-        self._pattern = self.get_pattern()
+        if pattern is None:
+            pattern = self.get_pattern()
+        self._pattern = sys.intern(pattern)
 
         if parent is not None:
             parent.add_child(self)
 
     # TODO docstring
     def add_child(self, child_tag_node):
+        if self._children is _EMPTY:
+            self._children = {}
+            self._pat_children = {}
         self._children[child_tag_node._tag] = child_tag_node
         self._pat_children[child_tag_node.get_pattern()] = child_tag_node
 
@@ -541,21 +1324,28 @@ class TagNode(TreeNode):
     # TODO docstring
     def get_pattern(self):
         if self._pattern is None:
-            to_return = self._tag.split(':')
-            tag_tokens = self._tag.split(':')
-            template_possibilities = self._template.get_template_match(self._tag)
-            for ii in range(0, len(tag_tokens)):
-                if template_possibilities[ii] in [tag_tokens[ii], '$']:
-                    to_return[ii] = tag_tokens[ii]
-                elif template_possibilities[ii] in ['?', '&']:
-                    to_return[ii] = template_possibilities[ii]
-                else:
-                    userlog.error("Tag does not match its own template!! \
-                                  Tag: %s ; Template: %s",
-                                  self._tag, self._template._tag)
-            self._pattern = ":".join(to_return)
+            self._pattern = TagNode.make_pattern(self._template, self._tag)
         return self._pattern
 
+    @staticmethod
+    def make_pattern(template, tag):
+        """Return the pattern of tag under template: its identifying tokens
+        as they are, with its other variable tokens replaced by '?' or '&'.
+        """
+        to_return = tag.split(':')
+        tag_tokens = tag.split(':')
+        template_possibilities = template.get_template_match(tag)
+        for ii in range(0, len(tag_tokens)):
+            if template_possibilities[ii] in [tag_tokens[ii], '$']:
+                to_return[ii] = tag_tokens[ii]
+            elif template_possibilities[ii] in ['?', '&']:
+                to_return[ii] = template_possibilities[ii]
+            else:
+                userlog.error("Tag does not match its own template!! \
+                              Tag: %s ; Template: %s",
+                              tag, template._tag)
+        return ":".join(to_return)
+
     # TODO docstring
     def aligns_with(self, other_tag):
         return (self._template == other_tag._template
@@ -579,89 +1369,351 @@ class TagNode(TreeNode):
         return to_return
 
     @staticmethod
-    def walk_rawfiles_into_tagnode_collection(directory, node_collection=None):
+    def walk_rawfiles_into_tagnode_collection(directory, node_collection=None,
+                                              jobs=1, graphics_index=None,
+                                              relpaths=None):
         """Load the graphics-relevant content of raw files into memory.
 
         * directory is a directory containing the raw files you want to load
-        into memory. Files with duplicate names will be treated as the same
-        file, even if they're in different sub-folders.
+        into memory, or a RawTreeIndex of one (see rawtree.py). Only its RAW
+        files are loaded.
         * node_collection is an optional parameter, to let you add additional
         raw files to the same node_collection. It is formatted the same as the
         return dict.
+        * jobs is the number of processes to parse files in. With more than
+        one, files are parsed in a process pool (see _parse_rawfile_compact)
+        and the parent process only assembles the TagNodes. The result is the
+        same either way.
+        * graphics_index is an optional dict mapping relative paths to the
+        top-level tags of the graphics files that go with them, such as the
+        collection returned for the graphics source itself. If it's given,
+        only the objects which could be bound to graphics are loaded: files
+        not in graphics_index are not read at all, and top-level objects whose
+        tags aren't in it are skipped along with everything under them.
+        * relpaths is an optional collection of paths relative to directory.
+        If it's given, only the files at those paths are loaded.
 
         The function returns a dictionary of string:dict{string:TagNode}. The
-        outer key is a filename which contains some graphics-relevant content.
-        The inner key is the tag corresponding with a top-level TagNode in that
-        file, and maps to that TagNode.
+        outer key is the path, relative to directory, of a file which
+        contains some graphics-relevant content. The inner key is the tag
+        corresponding with a top-level TagNode in that file, and maps to that
+        TagNode.
 
         This format is the expected input format of both parameters of
         bind_graphics_to_targets(graphics_nodes, target_nodes).
+
+        Tags are read through rawcache.raw_tags, so unchanged files are not
+        lexed again if a lexed-raw cache has been loaded.
         """
         if node_collection is None:
             node_collection = {}
 
         try:
-            for root, dirs, files in os.walk(directory):
-                for rawfile in files:
-                    # Only look at .txt files
-                    if '.txt' not in rawfile:
-                        userlog.info("Skipping file %s...", rawfile)
-                        continue
-                    userlog.info("Loading graphics tags from %s...", rawfile)
-                    global template_tree
-                    # curr_template_node keeps track of what format of tag
-                    # we've most recently seen, and thus what's valid next
-                    curr_template_node = template_tree
-                    # curr_real_node keeps track of the tag we stored that
-                    # corresponds to the most local instance of
-                    # curr_template_node.
-                    curr_real_node = None
-                    tarpath = os.path.join(root, rawfile)
-                    openfile = open(tarpath, encoding='cp437')
-                    for line in openfile:
-                        for tag in parsing.tags(line):
-                            matching_node = curr_template_node.find_match(tag)
-                            if matching_node is not None:
-                                curr_template_node = matching_node
-                                if ((curr_real_node is None or
-                                     matching_node._tag in template_tree._children)):
-                                    curr_real_node = TagNode(rawfile,
-                                                             matching_node,
-                                                             tag)
-                                else:
-                                    while (curr_real_node is not None and
-                                           matching_node._tag not in
-                                           curr_real_node._template._children):
-                                        curr_real_node = curr_real_node._parent
-                                    curr_real_node = TagNode(rawfile,
-                                                             matching_node,
-                                                             tag,
-                                                             curr_real_node)
-                                if rawfile not in node_collection:
-                                    node_collection[rawfile] = {}
-                                if curr_real_node._parent is None:
-                                    node_collection[rawfile][tag] = curr_real_node
-
-                    openfile.close()
-                    userlog.info("Finished processing %s .", rawfile)
+            for rawfile, placements in _walk_placements(
+                    directory, jobs, graphics_index, relpaths):
+                userlog.info("Loading graphics tags from %s...", rawfile)
+                TagNode._add_placements_to_collection(rawfile, placements,
+                                                      node_collection)
+                userlog.info("Finished processing %s .", rawfile)
         except:
             userlog.error("Exception in loading raws.")
             userlog.error(traceback.format_exc())
         else:
+            if rawcache.raw_cache is not None:
+                userlog.info("Lexed-raw cache: %i hits, %i misses.",
+                             rawcache.raw_cache.hits,
+                             rawcache.raw_cache.misses)
+                rawcache.raw_cache.trim()
             return node_collection
 
+    @staticmethod
+    def _add_placements_to_collection(rawfile, placements, node_collection):
+        """Build the TagNodes of one raw file into node_collection.
+
+        * placements is an iterable of (template, tag, parent, pattern)
+        tuples, as yielded by _place_tags. template may also be an index into
+        _template_list(), as sent back by worker processes.
+        """
+        nodes = []
+        templates = None
+        for template, tag, parent, pattern in placements:
+            if not isinstance(template, TemplateNode):
+                if templates is None:
+                    templates = _template_list()
+                template = templates[template]
+            node = TagNode(rawfile, template, tag,
+                           None if parent is None else nodes[parent], pattern)
+            nodes.append(node)
+            if rawfile not in node_collection:
+                node_collection[rawfile] = {}
+            if parent is None:
+                node_collection[rawfile][tag] = node
+
+
+def _walk_placements(directory, jobs=1, graphics_index=None, relpaths=None):
+    """Find the graphics-relevant tags of every raw file in directory.
+
+    The arguments are as for TagNode.walk_rawfiles_into_tagnode_collection.
+
+    Yields a (rawfile, placements) tuple for each raw file loaded, where
+    rawfile is the file's relative path and placements are as yielded by
+    _place_tags. With more than one job, templates in placements are indexes
+    into _template_list() instead.
+    """
+    if isinstance(directory, rawtree.RawTreeIndex):
+        tree = directory
+    else:
+        tree = rawtree.RawTreeIndex(directory)
+    rawfiles = []
+    for rawfile, indexed in tree.files.items():
+        if indexed.kind != rawtree.RAW:
+            userlog.info("Skipping file %s...", rawfile)
+            continue
+        if relpaths is not None and rawfile not in relpaths:
+            continue
+        if graphics_index is not None and rawfile not in graphics_index:
+            userlog.debug("No graphics for %s, skipping.", rawfile)
+            continue
+        rawfiles.append((rawfile, indexed.path))
+
+    if graphics_index is None:
+        wanted = [None] * len(rawfiles)
+    else:
+        wanted = [frozenset(graphics_index[rawfile])
+                  for rawfile, tarpath in rawfiles]
+    if jobs > 1 and len(rawfiles) > 1:
+        placements_by_file = _parse_rawfiles_in_pool(
+            [tarpath for rawfile, tarpath in rawfiles], wanted, jobs)
+    else:
+        placements_by_file = (
+            _place_tags(rawcache.raw_tags(tarpath), wanted_tags)
+            for (rawfile, tarpath), wanted_tags in zip(rawfiles, wanted))
+    for (rawfile, tarpath), placements in zip(rawfiles, placements_by_file):
+        yield rawfile, placements
+
+
+def _place_tags(records, wanted=None):
+    """Work out where each graphics-relevant tag in a raw file belongs.
+
+    * records is an iterable of the file's TagRecords.
+    * wanted is an optional set of top-level tags. If it's given, top-level
+    tags not in it, and everything under them, are skipped.
+
+    Yields a (template, tag, parent, pattern) tuple for each tag that matches
+    a template. template is the matching TemplateNode, parent is the index
+    (in yield order) of the tag's parent tag, or None for a top-level tag,
+    and pattern is the tag's pattern (see TagNode.get_pattern).
+
+    Skipped tags are still matched against the templates, since they decide
+    which templates the tags after them are matched against.
+    """
+    # The template, parent index and yield index (None if skipped) of each tag
+    # placed so far.
+    placed = []
+    yielded = 0
+    # curr_template_node keeps track of what format of tag we've most
+    # recently seen, and thus what's valid next
+    curr_template_node = template_tree
+    # current is the index of the tag we stored that corresponds to the most
+    # local instance of curr_template_node.
+    current = None
+    for record in records:
+        tag = record.tag
+        matching_node = curr_template_node.find_match(tag)
+        if matching_node is None:
+            continue
+        curr_template_node = matching_node
+        if current is None or matching_node._tag in template_tree._children:
+            parent = None
+        else:
+            parent = current
+            while (parent is not None and
+                   matching_node._tag not in placed[parent][0]._children):
+                parent = placed[parent][1]
+        if parent is None:
+            is_wanted = wanted is None or tag in wanted
+        else:
+            is_wanted = placed[parent][2] is not None
+        if is_wanted:
+            placed.append((matching_node, parent, yielded))
+            yielded += 1
+            yield (matching_node, tag,
+                   None if parent is None else placed[parent][2],
+                   TagNode.make_pattern(matching_node, tag))
+        else:
+            placed.append((matching_node, parent, None))
+        current = len(placed) - 1
+
+
+def _template_list():
+    """Return every TemplateNode in template_tree, in a fixed order.
+
+    Worker processes get a copy of the same tree, so an index into this list
+    identifies a template across processes.
+    """
+    to_return = []
+    to_visit = [template_tree]
+    while to_visit:
+        node = to_visit.pop()
+        to_return.append(node)
+        to_visit.extend(reversed(list(node._children.values())))
+    return to_return
+
+
+def _parse_rawfiles_in_pool(paths, wanted, jobs):
+    """Parse the raw files at paths in a pool of jobs worker processes.
+
+    * wanted is a list with the wanted top-level tags of each path, or None
+    for each path whose tags are all wanted (see _place_tags).
+
+    Yields one list of compact placements per path, in the same order as
+    paths, whatever order the workers finish in.
+    """
+    yield from _map_in_pool(_parse_rawfile_compact, jobs, paths, wanted)
+
+
+def _map_in_pool(function, jobs, *iterables):
+    """Call function on the items of iterables, as map() does, in a pool of
+    jobs worker processes set up with this process's templates, ASCII
+    conversions, lexed-raw cache and match cache settings.
+
+    * iterables are sequences, all as long as each other.
+
+    Yields the results in order, whatever order the workers finish in.
+    """
+    cache_args = None
+    if rawcache.raw_cache is not None:
+        cache_args = (rawcache.raw_cache.directory, None)
+    match_cache_size = 0 if match_cache is None else match_cache._max_size
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs, initializer=_init_parse_worker,
+            initargs=(template_tree, parsing.ascii_codes, cache_args,
+                      match_cache_size)) as pool:
+        yield from pool.map(function, *iterables,
+                            chunksize=max(1, len(iterables[0]) // (jobs * 4)))
+
+
+def _init_parse_worker(tree, ascii_codes, cache_args, match_cache_size):
+    """Set up a worker process with the parent's templates, ASCII
+    conversions, lexed-raw cache and match cache settings."""
+    global template_tree
+    global _worker_template_indexes
+    template_tree = tree
+    _worker_template_indexes = {node: ii for ii, node
+                                in enumerate(_template_list())}
+    parsing.ascii_codes = ascii_codes
+    if cache_args is not None:
+        rawcache.load_cache(*cache_args)
+    load_match_cache(match_cache_size)
+
+
+def _parse_rawfile_compact(path, wanted=None):
+    """Return the placements of the raw file at path, with each template
+    replaced by its index in _template_list(), for sending to the parent."""
+    indexes = _worker_template_indexes
+    return [(indexes[template], tag, parent, pattern)
+            for template, tag, parent, pattern
+            in _place_tags(rawcache.raw_tags(path), wanted)]
+
+
+def compile_edit_scripts_in_pool(target_tree, graphics_trees, pairs,
+                                 relpaths, jobs):
+    """Bind and compile the edit scripts of target raw files in a pool of
+    jobs worker processes, instead of binding them all in this one.
+
+    * target_tree is the RawTreeIndex of the target.
+    * graphics_trees is a list of the RawTreeIndexes of the graphics
+    sources.
+    * pairs maps target raw files to their graphics files, as returned by
+    rawtree.pair_rawfiles.
+    * relpaths are the target raw files to compile scripts for, relative to
+    the target.
+
+    Each worker parses one target file and its graphics file, binds them, and
+    sends back only the file's edit script (see _bind_rawfile_compact), so
+    no TagNodes or BoundNodes ever pass between processes.
+
+    Returns a dict mapping the relative paths of the files which have
+    something to bind to (digest, edit script) tuples, where digest is that
+    of the contents the script was compiled from. This is the edit_scripts
+    argument of write_modified_raws and write_patch.
+    """
+    userlog.info("Binding and compiling target files in %i processes...",
+                 jobs)
+    relpaths = [relpath for relpath in target_tree.relpaths(rawtree.RAW)
+                if relpath in relpaths and relpath in pairs]
+    target_paths = [target_tree.files[relpath].path for relpath in relpaths]
+    graphics_relpaths = [pairs[relpath] for relpath in relpaths]
+    # A graphics file in more than one source is loaded from each, in order,
+    # as walk_rawfiles_into_tagnode_collection would.
+    graphics_paths = [[graphics_tree.files[graphics_relpath].path
+                       for graphics_tree in graphics_trees
+                       if graphics_relpath in graphics_tree.files and
+                       graphics_tree.files[graphics_relpath].kind ==
+                       rawtree.RAW]
+                      for graphics_relpath in graphics_relpaths]
+    if len(relpaths) > 1:
+        compiled = _map_in_pool(_bind_rawfile_compact, jobs, relpaths,
+                                target_paths, graphics_relpaths,
+                                graphics_paths)
+    else:
+        compiled = map(_bind_rawfile_compact, relpaths, target_paths,
+                       graphics_relpaths, graphics_paths)
+    to_return = {relpath: script for relpath, script
+                 in zip(relpaths, compiled) if script is not None}
+    userlog.info("%i target files bound and compiled.", len(to_return))
+    return to_return
+
+
+def _bind_rawfile_compact(relpath, target_path, graphics_relpath,
+                          graphics_paths):
+    """Parse, bind and compile the edit script of one target raw file.
+
+    * relpath and target_path are the target file's relative and full paths.
+    * graphics_relpath is the relative path of the graphics file that goes
+    with it, and graphics_paths are the full paths of that file in each
+    graphics source that has it.
+
+    Returns the (digest, edit script) tuple described in
+    compile_edit_scripts_in_pool, or None if the file has nothing to bind,
+    in which case its target file isn't read at all.
+    """
+    graphics_collection = {}
+    for path in graphics_paths:
+        TagNode._add_placements_to_collection(
+            graphics_relpath, _place_tags(rawcache.raw_tags(path)),
+            graphics_collection)
+    graphics_tops = graphics_collection.get(graphics_relpath)
+    if graphics_tops is None:
+        return None
+    with open(target_path, 'rb') as sourcefile:
+        source = sourcefile.read()
+    target_collection = {}
+    TagNode._add_placements_to_collection(
+        relpath, _place_tags(rawcache.raw_tags(target_path, source),
+                             frozenset(graphics_tops)),
+        target_collection)
+    target_tops = target_collection.get(relpath)
+    if target_tops is None:
+        return None
+    bound_tops = BoundNode._bind_file(relpath, graphics_tops, target_tops)
+    return (_digest_source(source),
+            BoundNode.compile_edit_script(bound_tops, target_path, source))
+
 
 # TODO docstring
 class BoundNode(TreeNode):
+    __slots__ = ('_additional', '_targets_only', '_target_node',
+                 '_graphics_node', '_merged')
+
     def __init__(self, target_node, graphics_node, parent=None):
         TreeNode.__init__(self, parent)
         self._tag = target_node._tag
-        self._popped_children = {}
-        self._additional = []
-        self._targets_only = {}
-        self._are_addl_popped = False
+        self._additional = ()
+        self._targets_only = _EMPTY
         self._target_node = target_node
         self._graphics_node = graphics_node
+        self._merged = None
         if parent is not None:
             parent.add_child(self)
         else:
@@ -669,8 +1721,9 @@ class BoundNode(TreeNode):
 
     # TODO docstring
     def add_child(self, child_node):
+        if self._children is _EMPTY:
+            self._children = {}
         self._children[child_node._target_node._tag] = child_node
-        self._popped_children[child_node._target_node._tag] = False
 
     # TODO docstring
     def is_graphics_tag(self):
@@ -681,77 +1734,62 @@ class BoundNode(TreeNode):
 
     # TODO docstring
     def create_child_nodes(self):
+        # Children are visited in file order, rather than set order, so
+        # additional tags come out in the same order on every run.
+        target_children = self._target_node._pat_children
+        graphics_children = self._graphics_node._pat_children
         # Children with pattern keys in both target & graphics
-        for shared_key in set(self._target_node._pat_children.keys()
-                              ).intersection(set(self._graphics_node._pat_children.keys())):
-            new_node = BoundNode(self._target_node._pat_children[shared_key],
-                                 self._graphics_node._pat_children[shared_key],
+        for shared_key in target_children.keys():
+            if shared_key not in graphics_children:
+                continue
+            new_node = BoundNode(target_children[shared_key],
+                                 graphics_children[shared_key],
                                  self)
             self.add_child(new_node)
             new_node.create_child_nodes()
         # Children with pattern keys in target but not in graphics
-        for target_key in set(self._target_node._pat_children.keys()
-                              ) - set(self._graphics_node._pat_children.keys()):
-            target_in_question = self._target_node._pat_children[target_key]
+        for target_key in target_children.keys():
+            if target_key in graphics_children:
+                continue
+            target_in_question = target_children[target_key]
             if target_in_question.is_standalone_tag():
                 self.add_child(BoundNode(target_in_question, None, self))
             else:
+                if self._targets_only is _EMPTY:
+                    self._targets_only = {}
                 self._targets_only[target_in_question._tag] = target_in_question
         # Children with pattern keys in graphics but not in target
-        for graphics_key in set(self._graphics_node._pat_children.keys()
-                                ) - set(self._target_node._pat_children.keys()):
-            graphics_in_question = self._graphics_node._pat_children[graphics_key]
+        for graphics_key in graphics_children.keys():
+            if graphics_key in target_children:
+                continue
+            graphics_in_question = graphics_children[graphics_key]
             if graphics_in_question.is_standalone_tag():
-                self._additional.append(graphics_in_question)
+                self._additional += (graphics_in_question,)
         # End
 
-    # TODO docstring
-    def are_all_children_popped(self):
-        to_return = True
-        for child in self._popped_children.keys():
-            to_return &= self._popped_children[child]
-        return to_return
+    def unpopped_additional(self, popped):
+        """Return the additional tags of this node and its ancestors, most
+        local first, skipping nodes already in popped.
 
-    # TODO docstring
-    def pop_addl(self):
+        * popped is the set of BoundNodes whose additional tags have already
+        been written. The nodes returned from are added to it.
+        """
         to_return = []
-        # If this hasn't had its additionals popped and is ready to pop
-        if (not self._are_addl_popped):
-            self._are_addl_popped = True
-            to_return.extend(self._additional)
-        if self._parent is not None:
-            to_return.extend(self._parent.pop_addl())
+        node = self
+        while node is not None:
+            if node not in popped:
+                popped.add(node)
+                to_return.extend(node._additional)
+            node = node._parent
         return to_return
 
-    # TODO docstring
-    def reset_addl(self):
-        self._are_addl_popped = False
-        for child in self._children.keys():
-            self._children[child].reset_addl()
-
-    # TODO docstring
     def get_merged(self):
-        return self._target_node.apply_graphics(self._graphics_node)
-
-    # TODO docstring
-    def pop_child(self, target_tag):
-        if target_tag not in self._children.keys():
-            return self
-        else:
-            if self._popped_children[target_tag]:
-                userlog.warning("Popping tag that has already been popped: %s \
-                                child of %s", target_tag, self._tag)
-
-            return self._children[target_tag]
-
-    # TODO docstring
-    def pop_self(self):
-        if self._parent is not None:
-            also_self = self._parent.pop_child(self._tag)
-            if also_self != self:
-                userlog.error("Big problem: Bound Node with _tag %s is not its \
-                              parent's ._children[%s]", self._tag, self._tag)
-        return self
+        """Return the merged tag string for this node, or None if there is
+        no graphics tag to merge. The result is only computed once."""
+        if self._merged is None and self._graphics_node is not None:
+            self._merged = self._target_node.apply_graphics(
+                self._graphics_node)
+        return self._merged
 
     # TODO docstring
     def is_there_a_difference(self):
@@ -771,26 +1809,113 @@ class BoundNode(TreeNode):
         else:
             return None
 
+    @staticmethod
+    def compile_edit_script(bound_tops, sourcepath, source=None):
+        """Work out every change to make to a target raw file when merging.
+
+        * bound_tops is the file's {tag:BoundNode} dict, as returned by
+        bind_graphics_to_targets.
+        * sourcepath is the path to the target raw file.
+        * source is the file's contents, as bytes, if they've already been
+        read. Otherwise the file is read here.
+
+        Returns a tuple of Edits, in file order, one for each tag that needs
+        something done to it:
+            * offset and end are the tag's byte offsets in the file.
+            * replacement is the text to put in place of the tag (empty to
+            remove it), or None to leave it as it is.
+            * missing is a tuple of target tags under the tag which have no
+            graphics, to warn about before the line.
+            * additional is a tuple of graphics tags to add after the line.
+
+        The BoundNodes are only read, never changed, so scripts can be
+        compiled for many files at once and written as often as needed.
+        """
+        if source is None:
+            with open(sourcepath, 'rb') as sourcefile:
+                source = sourcefile.read()
+        trace = userlog.isEnabledFor(config.TRACE_LEVEL)
+        merged_count = 0
+        removed_count = 0
+        added_count = 0
+        missing_count = 0
+        edits = []
+        curr_node = None
+        # BoundNodes whose additional tags have already been placed.
+        popped = set()
+        for line_no, offset, tag, end in rawcache.raw_tags(sourcepath,
+                                                            source):
+            replacement = "[" + tag + "]"
+            missing = ()
+            additional = ()
+            matching_node = None
+            if tag in bound_tops.keys():
+                matching_node = bound_tops[tag]
+            elif curr_node is not None:
+                matching_node = curr_node.find_match(tag)
+            if matching_node is not None:
+                curr_node = matching_node
+                if matching_node.is_there_a_difference():
+                    merged_tag = matching_node.get_merged()
+                    if merged_tag is not None:
+                        if trace:
+                            userlog.log(config.TRACE_LEVEL,
+                                        "Replacing %s with %s at line %i.",
+                                        tag, merged_tag, line_no)
+                        merged_count += 1
+                        replacement = "[" + merged_tag + "]"
+                    else:
+                        if trace:
+                            userlog.log(config.TRACE_LEVEL,
+                                        "Removing tag %s at line %i.", tag,
+                                        line_no)
+                        removed_count += 1
+                        replacement = ""
+                additional = tuple(
+                    tag_node._tag for tag_node
+                    in matching_node.unpopped_additional(popped))
+                added_count += len(additional)
+            elif curr_node is not None:
+                problem_parent = curr_node.find_targetsonly_owner(tag)
+                if ((problem_parent is not None and
+                     problem_parent._targets_only[tag].has_graphics_info())):
+                    missing = (tag,)
+                    missing_count += 1
+            # Tags are written escaped, and with any line breaks in them
+            # dropped, so only tags which come out the same can be skipped.
+            if replacement == source[offset:end].decode('cp437'):
+                replacement = None
+            if replacement is not None or missing or additional:
+                edits.append(Edit(offset, end, replacement, missing,
+                                  additional))
+        userlog.debug("%s: %i tags merged, %i removed, %i added, %i missing " +
+                      "graphics.", os.path.basename(sourcepath), merged_count,
+                      removed_count, added_count, missing_count)
+        return tuple(edits)
+
     @staticmethod
     def bind_graphics_to_targets(graphics_nodes, targets_nodes):
         """Associate two collections of TagNodes with each other,
         in preparation for merging.
 
         * graphics_nodes and targets_nodes are dicts of type
-        string:dict{string:TagNode}, where the outer key is a file name, the
-        inner keys are tags associated with top-level TagNodes, and the
-        TagNodes are of course those same top-level TagNodes. These
-        string:string:TagNodes are expected to be produced by
-        walk_rawfiles_into_tagnode_collection.
+        string:dict{string:TagNode}, where the outer key is a target file's
+        relative path, the inner keys are tags associated with top-level
+        TagNodes, and the TagNodes are of course those same top-level
+        TagNodes. These string:string:TagNodes are expected to be produced by
+        walk_rawfiles_into_tagnode_collection. graphics_nodes should be keyed
+        by the target files each graphics file goes with (see
+        rawtree.pair_rawfiles).
 
         The function returns a similarly-formatted dict of BoundNodes, in the
-        format string:dict{string:BoundNode}, where the outer key is a file
-        name, the inner key is the tag associated with the target_nodes of top
-        level BoundNodes, and the BoundNodes are, as usual, those BoundNodes.
+        format string:dict{string:BoundNode}, where the outer key is a file's
+        relative path, the inner key is the tag associated with the
+        target_nodes of top level BoundNodes, and the BoundNodes are, as usual,
+        those BoundNodes.
 
         The BoundNodes in the return dict are generated from the two arguments,
         by matching up TagNodes from graphics_nodes and targets_nodes based on
-        their filenames, templates, and parents.
+        their files, templates, and parents.
 
         If a TagNode in graphics_nodes has no corresponding TagNode in
         targets_nodes, it is evaluated for standalone status. If it is a
@@ -803,24 +1928,36 @@ class BoundNode(TreeNode):
         location missing.log ). If not, it is dropped.
         """
         userlog.info("Binding graphics source tags to target tags...")
-        to_return = {}
-        for filename in targets_nodes.keys():
-            # Files which both share, both have found graphics in, and haven't
-            # been put in the return dict yet.
-            if ((filename in graphics_nodes.keys() and
-                 filename not in to_return.keys())):
-                userlog.info("Binding tags for %s ...", filename)
-                to_return[filename] = {}
-                for top_level_tag in targets_nodes[filename].keys():
-                    # Top level tags which both share, both have found graphics
-                    # in, and haven't been put in the return dict yet.
-                    if ((top_level_tag in graphics_nodes[filename] and
-                         top_level_tag not in to_return[filename].keys())):
-                        # Create new BoundNode tree and put it in the return
-                        # dict.
-                        to_return[filename][top_level_tag] = \
-                            BoundNode(targets_nodes[filename][top_level_tag],
-                                      graphics_nodes[filename][top_level_tag])
-                userlog.info("%s tags bound.", filename)
+        # Files which both share, and both have found graphics in.
+        filenames = [filename for filename in targets_nodes.keys()
+                     if filename in graphics_nodes.keys()]
+        to_return = {filename: BoundNode._bind_file(filename,
+                                                    graphics_nodes[filename],
+                                                    targets_nodes[filename])
+                     for filename in filenames}
         userlog.info("Tag binding complete.")
         return to_return
+
+    @staticmethod
+    def _bind_file(filename, graphics_tops, target_tops):
+        """Bind the top-level TagNodes of one file.
+
+        * graphics_tops and target_tops are the {tag:TagNode} dicts of the
+        file in the graphics and target collections.
+
+        Returns the file's {tag:BoundNode} dict.
+        """
+        userlog.info("Binding tags for %s ...", filename)
+        to_return = {}
+        for top_level_tag in target_tops.keys():
+            # Top level tags which both share, both have found graphics
+            # in, and haven't been put in the return dict yet.
+            if ((top_level_tag in graphics_tops and
+                 top_level_tag not in to_return.keys())):
+                # Create new BoundNode tree and put it in the return
+                # dict.
+                to_return[top_level_tag] = \
+                    BoundNode(target_tops[top_level_tag],
+                              graphics_tops[top_level_tag])
+        userlog.info("%s tags bound.", filename)
+        return to_return
@@ -0,0 +1,292 @@
+'''
+Created on Oct 18, 2026
+
+@author: Button
+'''
+
+from src.bamm.common import config, rawtree
+import hashlib
+import json
+import os
+import traceback
+
+userlog = config.userlog
+
+# Bump this whenever the code starts producing different output from the
+# same inputs, so outputs recorded by older versions get rebuilt.
+MANIFEST_VERSION = 4
+_MANIFEST_SUFFIX = '.manifest'
+
+
+def manifest_path(outputdir):
+    """Return the path of the run manifest kept next to outputdir."""
+    return os.path.normpath(outputdir) + _MANIFEST_SUFFIX
+
+
+class RunManifest():
+    """A record of the inputs each output file of a run was built from.
+
+    The manifest is a JSON file kept next to the output directory. For every
+    output file, keyed by its path relative to the output directory, it
+    holds:
+        * target: the size, mtime and digest of the target raw file.
+        * graphics: a digest of every graphics source file that goes with the
+        target raw file (see rawtree.pair_rawfiles), or None if there are
+        none.
+        * templates and ascii: digests of the templates and ascii files.
+        * override: the size, mtime and digest of the graphics source file
+        copied over the target's (see find_graphics_overrides), or None.
+        Only this counts for such files, so the other inputs are all None.
+        * output: the size and mtime of the output file, when it was written.
+
+    A file whose inputs all match, and whose output hasn't been touched since,
+    doesn't need to be written again. Digests are only recomputed for files
+    whose size or mtime has changed.
+    In a manifest which isn't stored, the digests of files which don't need
+    them are left as None.
+
+    Members:
+        * _path is where the manifest is stored. It may be None, for a
+        manifest which is only used within a run and never stored; then
+        every file is out of date.
+        * _settings is a list of everything besides the files themselves
+        which decides the output, such as the source directories and ignore
+        list. If it doesn't match the stored one, every file is out of date.
+        * _is_current is whether the stored entries can be trusted.
+        * files is the dict of entries described above.
+        * _graphics_files maps graphics source paths to their size, mtime and
+        digest, so unchanged graphics files don't need to be read again.
+        * _identical is the set of target raw files which are the same as
+        their graphics files, as of the last refresh().
+    """
+
+    def __init__(self, path, settings):
+        self._path = path
+        self._settings = settings
+        self._is_current = False
+        self.files = {}
+        self._graphics_files = {}
+        self._identical = set()
+        if path is not None:
+            self._load()
+
+    def _load(self):
+        try:
+            with open(self._path, 'r', encoding='utf-8') as manifest_file:
+                stored = json.load(manifest_file)
+            files = stored['files']
+            graphics_files = stored['graphics_files']
+        except FileNotFoundError:
+            userlog.info("No run manifest at %s ; writing all files.",
+                         self._path)
+            return
+        except (OSError, ValueError, KeyError, TypeError):
+            userlog.warning("Could not read run manifest %s ; writing all " +
+                            "files.", self._path)
+            userlog.warning(traceback.format_exc())
+            return
+        # Keep the old entries even if they can't be trusted, so outputs of
+        # files which have since disappeared can still be found.
+        self.files = files
+        if ((stored.get('version') == MANIFEST_VERSION and
+             stored.get('settings') == self._settings)):
+            self._is_current = True
+            self._graphics_files = graphics_files
+        else:
+            userlog.info("Run manifest %s is out of date; writing all files.",
+                         self._path)
+
+    def refresh(self, target_tree, graphics_trees, pairs, templatefile,
+                asciifile, outputdir, overrides=None):
+        """Bring the manifest's entries up to date with the inputs on disk.
+
+        * target_tree is the RawTreeIndex of the target raw source directory.
+        * graphics_trees is a list of RawTreeIndexes of the graphics source
+        directories.
+        * pairs maps target raw files to the graphics files that go with
+        them, as returned by rawtree.pair_rawfiles.
+        * templatefile and asciifile are the templates and ascii files.
+        * outputdir is the output directory.
+        * overrides is an optional dict of the graphics source files which
+        are copied over the target's, as returned by find_graphics_overrides.
+
+        Returns a tuple (stale, removed) of sets of paths, relative to
+        outputdir. stale holds the files which need to be written; removed
+        holds the files whose source no longer exists.
+        """
+        if overrides is None:
+            overrides = {}
+        # A manifest which isn't stored has nothing to compare against, and
+        # every file is written anyway, so only the digests the identical
+        # file check needs are worth reading the files for: those of the
+        # target raw files with graphics, and of their graphics files.
+        is_stored = self._path is not None
+        templates_digest = _digest_file(templatefile)
+        ascii_digest = _digest_file(asciifile)
+        if is_stored:
+            graphics_digests = self._digest_graphics(graphics_trees)
+        else:
+            graphics_digests = self._digest_graphics(graphics_trees,
+                                                     set(pairs.values()))
+        old_files = self.files
+        new_files = {}
+        self._identical = set()
+        for relpath, indexed in target_tree.files.items():
+            if relpath in overrides:
+                continue
+            old_entry = old_files.get(relpath)
+            if is_stored or relpath in pairs:
+                target = _stat_and_digest(indexed.path,
+                                          old_entry and old_entry['target'],
+                                          indexed.stat)
+            else:
+                target = _stat(indexed.path, indexed.stat) + [None]
+            digests = graphics_digests.get(pairs.get(relpath))
+            if digests is not None and set(digests) == {target[2]}:
+                self._identical.add(relpath)
+            new_files[relpath] = {
+                'target': target,
+                'graphics': digests and _digest_strings(digests),
+                'templates': templates_digest,
+                'ascii': ascii_digest,
+                'override': None,
+                'output': None}
+        for relpath, path in overrides.items():
+            old_entry = old_files.get(relpath)
+            new_files[relpath] = {
+                'target': None,
+                'graphics': None,
+                'templates': None,
+                'ascii': None,
+                'override': (_stat_and_digest(
+                    path, old_entry and old_entry.get('override'))
+                             if is_stored else _stat(path) + [None]),
+                'output': None}
+
+        stale = set()
+        for relpath, entry in new_files.items():
+            old_entry = old_files.get(relpath)
+            if ((self._is_current and old_entry is not None and
+                 all(old_entry[key] == entry[key] for key
+                     in ('target', 'graphics', 'templates', 'ascii',
+                         'override')) and
+                 _stat(os.path.join(outputdir, relpath)) ==
+                 old_entry['output'])):
+                entry['output'] = old_entry['output']
+            else:
+                stale.add(relpath)
+        removed = set(old_files.keys()) - set(new_files.keys())
+        self.files = new_files
+        self._is_current = True
+        return stale, removed
+
+    def _digest_graphics(self, graphics_trees, relpaths=None):
+        """Return a dict mapping the relative path of each graphics source
+        raw file to a list of the digests of the files at that path, one for
+        each graphics source directory that has one.
+
+        * relpaths is an optional collection of relative paths. If it's
+        given, only the files at those paths are digested.
+        """
+        digested_files = {}
+        digests_by_relpath = {}
+        for graphics_tree in graphics_trees:
+            for relpath in graphics_tree.relpaths(rawtree.RAW):
+                if relpaths is not None and relpath not in relpaths:
+                    continue
+                indexed = graphics_tree.files[relpath]
+                path = os.path.abspath(indexed.path)
+                digested_files[path] = _stat_and_digest(
+                    path, self._graphics_files.get(path), indexed.stat)
+                digests_by_relpath.setdefault(relpath, []).append(
+                    digested_files[path][2])
+        self._graphics_files = digested_files
+        return digests_by_relpath
+
+    def identical_files(self):
+        """Return the target raw files, by relative path, which are
+        byte-identical to every graphics source file that goes with them, as
+        of the last refresh()."""
+        return self._identical
+
+    def record_outputs(self, outputdir, relpaths):
+        """Record the size and mtime of the freshly written output files at
+        relpaths, relative to outputdir."""
+        for relpath in relpaths:
+            self.files[relpath]['output'] = _stat(os.path.join(outputdir,
+                                                               relpath))
+
+    def save(self):
+        """Write the manifest to disk."""
+        if self._path is None:
+            return
+        temp_path = self._path + '.tmp'
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as manifest_file:
+                json.dump({'version': MANIFEST_VERSION,
+                           'settings': self._settings,
+                           'files': self.files,
+                           'graphics_files': self._graphics_files},
+                          manifest_file, indent=1, sort_keys=True)
+            os.replace(temp_path, self._path)
+            userlog.info("Run manifest written to %s .", self._path)
+        except OSError:
+            userlog.warning("Could not write run manifest %s", self._path)
+            userlog.warning(traceback.format_exc())
+
+
+def remove_outputs(outputdir, relpaths, targetdir):
+    """Delete the output files at relpaths, relative to outputdir, along with
+    any directories they leave empty which targetdir no longer has."""
+    for relpath in sorted(relpaths):
+        path = os.path.join(outputdir, relpath)
+        try:
+            os.remove(path)
+            userlog.info("Removed %s , whose source file is gone.", relpath)
+        except FileNotFoundError:
+            pass
+        reldir = os.path.dirname(relpath)
+        while reldir and not os.path.isdir(os.path.join(targetdir, reldir)):
+            try:
+                os.rmdir(os.path.join(outputdir, reldir))
+            except OSError:
+                break
+            reldir = os.path.dirname(reldir)
+
+
+def _stat(path, stat_result=None):
+    """Return [size, mtime] of the file at path, or None if it's missing.
+
+    * stat_result is the file's os.stat_result, if it's already known.
+    """
+    if stat_result is None:
+        try:
+            stat_result = os.stat(path)
+        except FileNotFoundError:
+            return None
+    return [stat_result.st_size, stat_result.st_mtime_ns]
+
+
+def _stat_and_digest(path, known=None, stat_result=None):
+    """Return [size, mtime, digest] of the file at path.
+
+    * known is the last [size, mtime, digest] recorded for the file, if any.
+    If the size and mtime still match, it is returned as is.
+    * stat_result is the file's os.stat_result, if it's already known.
+    """
+    stat = _stat(path, stat_result)
+    if known is not None and known[:2] == stat:
+        return known
+    return stat + [_digest_file(path)]
+
+
+def _digest_file(path):
+    with open(path, 'rb') as file:
+        return hashlib.blake2b(file.read(), digest_size=16).hexdigest()
+
+
+def _digest_strings(strings):
+    digest = hashlib.blake2b(digest_size=16)
+    for string in strings:
+        digest.update(string.encode('ascii'))
+    return digest.hexdigest()
@@ -0,0 +1,441 @@
+'''
+Created on Oct 18, 2026
+
+@author: Button
+'''
+
+from src.bamm.common import config, parsing, rawtree
+from src.bamm.graphics import archive, graphics, manifest, tagstore
+import collections
+import os
+import time
+import traceback
+
+userlog = config.userlog
+
+# A target raw file as last parsed by a MergeSession: its size and mtime, the
+# top-level graphics tags it was parsed for, and its {tag:TagNode} dict.
+_ParsedTarget = collections.namedtuple('_ParsedTarget',
+                                       ['stat', 'wanted', 'tops'])
+
+
+class MergeSession():
+    """One graphics set, ready to be merged into any number of targets.
+
+    A session loads the templates, ASCII conversions and match cache once,
+    indexes the graphics source once, and keeps every graphics file it has
+    parsed, so each merge() only has to read its target. Graphics files are
+    parsed the first time a target needs them, so a merge with nothing out of
+    date doesn't parse any.
+
+    With more than one job, and the tags held in memory, each out-of-date
+    file is instead parsed, bound and compiled in a worker process (see
+    compile_edit_scripts_in_pool), and nothing parsed is kept between merges.
+    The lexed-raw cache still spares the workers lexing unchanged files.
+
+    The graphics source is taken as it was when the session was created,
+    until refresh_graphics() is called. watch() does that for you, and
+    merges again whenever anything changes.
+
+    Members:
+        * graphics_dirs is the list of graphics source directories.
+        * _templatefile and _asciifile are the templates and ascii files.
+        * _template_tree, _ascii_codes and _match_cache are this session's
+        graphics.template_tree, parsing.ascii_codes and graphics.match_cache.
+        Those are module globals, which the rest of the code reads, so each
+        merge() puts this session's back in place first.
+        * _ignore_patterns and _overwrite_patterns are the graphics_ignore
+        and graphics_overwrite regex lists, and _ignore_matcher and
+        _overwrite_matcher the PathMatchers built from them.
+        * _jobs is the number of jobs to load, bind and write files in.
+        * _graphics_trees are the RawTreeIndexes of graphics_dirs.
+        * _overrides are the graphics files copied over the target's, as
+        returned by find_graphics_overrides.
+        * _loaded_graphics is the set of the relative paths of the graphics
+        files parsed so far.
+        * _graphics_tags_by_file is the collection of those files' tags, when
+        the tags are held in memory.
+        * _tag_store is the TagStore the tags are held in instead, or None.
+        * _target_dir is the last target merged into, and _parsed_targets
+        maps the relative paths of the raw files parsed from it to
+        _ParsedTargets, so a file which hasn't changed isn't parsed again by
+        the next merge into the same target. Only the last target's files are
+        kept, and only when the tags are held in memory.
+    """
+
+    def __init__(self, graphics_dirs, templatefile, asciifile, jobs=1,
+                 ignore_patterns=(), overwrite_patterns=(),
+                 template_artifact=None, match_cache_size=100000,
+                 tag_store=None):
+        """Load everything that's the same for every merge.
+
+        * graphics_dirs is a list of graphics source directories.
+        * templatefile and asciifile are the templates and ascii files, as
+        for load_all_templates and _load_ascii_conversions.
+        * jobs is the number of jobs to load, bind and write files in.
+        * ignore_patterns and overwrite_patterns are lists of path regexes,
+        as for the graphics_ignore and graphics_overwrite properties.
+        * template_artifact is an optional precompiled template tree, as for
+        load_all_templates.
+        * match_cache_size is the size of the template match cache, as for
+        load_match_cache.
+        * tag_store is an optional path to keep the tags in, on disk, instead
+        of in memory (see TagStore).
+        """
+        self.graphics_dirs = list(graphics_dirs)
+        self._templatefile = templatefile
+        self._asciifile = asciifile
+        self._jobs = jobs
+        self._ignore_patterns = list(ignore_patterns)
+        self._overwrite_patterns = list(overwrite_patterns)
+
+        # Start from empty globals, so nothing from another session is mixed
+        # into this one's.
+        parsing.ascii_codes = None
+        parsing._load_ascii_conversions(asciifile)
+        self._ascii_codes = parsing.ascii_codes
+        graphics.template_tree = None
+        graphics.load_all_templates(templatefile, template_artifact)
+        self._template_tree = graphics.template_tree
+        graphics.load_match_cache(match_cache_size)
+        self._match_cache = graphics.match_cache
+
+        self._ignore_matcher = parsing.PathMatcher(self._ignore_patterns)
+        self._overwrite_matcher = parsing.PathMatcher(
+            self._overwrite_patterns)
+        self._graphics_trees = [
+            rawtree.RawTreeIndex(graphics_dir, self._ignore_matcher,
+                                 self._overwrite_matcher)
+            for graphics_dir in self.graphics_dirs]
+        self._overrides = graphics.find_graphics_overrides(
+            self._graphics_trees)
+        self._loaded_graphics = set()
+        self._graphics_tags_by_file = {}
+        self._target_dir = None
+        self._parsed_targets = {}
+        if tag_store is None:
+            self._tag_store = None
+        else:
+            self._tag_store = tagstore.TagStore(tag_store)
+
+    @staticmethod
+    def from_config():
+        """Return a MergeSession with the settings in the run config, which
+        must already be loaded."""
+        graphics_dirs = [config.properties[config.GRAPHICS_SOURCEDIR][1]]
+        # Optional extra_graphics property
+        if config.get_property(config.EXTRA_GRAPHICS_SOURCEDIR) is not None:
+            graphics_dirs.append(
+                config.properties[config.EXTRA_GRAPHICS_SOURCEDIR][1])
+        template_artifact = None
+        if config.get_property(config.CACHEDIR) is not None:
+            template_artifact = os.path.join(
+                config.get_property(config.CACHEDIR), 'templates.bin')
+        return MergeSession(
+            graphics_dirs,
+            config.properties[config.TEMPLATEFILE][1],
+            config.properties[config.ASCII_FILE][1],
+            jobs=config.get_property(config.JOBS, 1),
+            ignore_patterns=config.properties[config.GRAPHICS_IGNORE_LIST][1:],
+            overwrite_patterns=config.properties[
+                config.GRAPHICS_OVERWRITE_LIST][1:],
+            template_artifact=template_artifact,
+            match_cache_size=config.get_property(config.MATCH_CACHE_SIZE,
+                                                 100000),
+            tag_store=config.get_property(config.TAG_STORE))
+
+    def _activate(self):
+        """Put this session's templates, ASCII conversions and match cache
+        in the module globals the rest of the code reads them from."""
+        graphics.template_tree = self._template_tree
+        parsing.ascii_codes = self._ascii_codes
+        graphics.match_cache = self._match_cache
+
+    def merge(self, target_dir, output_dir, patchpath=None, archivepath=None,
+              archive_compression=None, target_tree=None):
+        """Merge the graphics set into the raws in target_dir.
+
+        * output_dir is where the merged raws go. A run manifest is kept
+        next to it, so only the files whose inputs have changed since the
+        last merge into it are written again (see RunManifest).
+        * patchpath is an optional patch file to write the changes to
+        instead, as for write_patch.
+        * archivepath is an optional zip or tar file to write the output to
+        instead, as for OutputArchive; archive_compression is its
+        compression level.
+        * target_tree is an optional RawTreeIndex of target_dir, if it has
+        already been indexed with this session's ignore list.
+
+        A patch or archive covers every file, so it's rebuilt in full every
+        time.
+
+        Returns the set of the files written, relative to output_dir.
+        """
+        self._activate()
+        jobs = self._jobs
+        if archivepath is not None:
+            # Check the archive type before doing any of the work.
+            archive.archive_type(archivepath)
+        if patchpath is not None or archivepath is not None:
+            manifestpath = None
+        else:
+            manifestpath = manifest.manifest_path(output_dir)
+        run_manifest = manifest.RunManifest(
+            manifestpath,
+            [os.path.abspath(target_dir),
+             [os.path.abspath(graphics_dir)
+              for graphics_dir in self.graphics_dirs],
+             self._ignore_patterns,
+             self._overwrite_patterns])
+        if target_tree is None:
+            target_tree = rawtree.RawTreeIndex(target_dir,
+                                               self._ignore_matcher)
+        pairs = rawtree.pair_rawfiles(target_tree, self._graphics_trees)
+        overrides = self._overrides
+        stale, removed = run_manifest.refresh(
+            target_tree, self._graphics_trees, pairs, self._templatefile,
+            self._asciifile, output_dir, overrides)
+        userlog.info("%i output files out of date, %i to remove.",
+                     len(stale), len(removed))
+        manifest.remove_outputs(output_dir, removed, target_dir)
+
+        if stale:
+            # Files which are the same in the graphics source and the target
+            # have nothing to merge, so they skip straight to being copied.
+            identical = run_manifest.identical_files()
+            userlog.info("%i files are identical in graphics source and " +
+                         "target; copying them as they are.",
+                         len(stale & identical))
+            to_bind = {relpath for relpath in stale
+                       if relpath in pairs} - identical
+            edit_scripts = None
+            if self._tag_store is not None:
+                tags_to_apply = self._bind_in_store(target_tree, pairs,
+                                                    to_bind)
+            elif jobs > 1:
+                # Each file is bound in a worker process, which sends back
+                # only its edit script.
+                tags_to_apply = {}
+                edit_scripts = graphics.compile_edit_scripts_in_pool(
+                    target_tree, self._graphics_trees, pairs, to_bind, jobs)
+            else:
+                tags_to_apply = self._bind_in_memory(target_tree, pairs,
+                                                     to_bind)
+            if patchpath is not None:
+                # Overrides are whole files, often images, which a patch
+                # can't hold.
+                if overrides:
+                    userlog.warning(
+                        "%i graphics_overwrite files are left out of the " +
+                        "patch; copy them over from the graphics source " +
+                        "yourself.", len(overrides))
+                graphics.write_patch(tags_to_apply, target_tree, patchpath,
+                                     only=stale - overrides.keys(),
+                                     edit_scripts=edit_scripts)
+            elif archivepath is not None:
+                output_archive = archive.OutputArchive(archivepath,
+                                                       archive_compression)
+                try:
+                    graphics.write_modified_raws(tags_to_apply, target_tree,
+                                                 output_archive, only=stale,
+                                                 jobs=jobs,
+                                                 overrides=overrides,
+                                                 edit_scripts=edit_scripts)
+                except:
+                    output_archive.discard()
+                    raise
+                output_archive.close()
+            else:
+                graphics.write_modified_raws(tags_to_apply, target_tree,
+                                             output_dir, only=stale,
+                                             jobs=jobs, overrides=overrides,
+                                             edit_scripts=edit_scripts)
+                run_manifest.record_outputs(output_dir, stale)
+        else:
+            userlog.info("Output is up to date.")
+        run_manifest.save()
+
+        if self._match_cache is not None:
+            userlog.info("Template match cache: %i hits, %i misses.",
+                         self._match_cache.hits, self._match_cache.misses)
+        return stale
+
+    def refresh_graphics(self):
+        """Index the graphics source again, and forget the parsed graphics
+        files which have changed since, so the next merge() parses them
+        again.
+
+        Returns the set of graphics files which have been added, removed or
+        changed, by relative path.
+        """
+        new_trees = [
+            rawtree.RawTreeIndex(graphics_dir, self._ignore_matcher,
+                                 self._overwrite_matcher)
+            for graphics_dir in self.graphics_dirs]
+        changed = set()
+        for old_tree, new_tree in zip(self._graphics_trees, new_trees):
+            changed |= rawtree.changed_files(old_tree, new_tree)
+        self._graphics_trees = new_trees
+        if changed:
+            self._overrides = graphics.find_graphics_overrides(new_trees)
+            forgotten = changed & self._loaded_graphics
+            self._loaded_graphics -= forgotten
+            for relpath in forgotten:
+                self._graphics_tags_by_file.pop(relpath, None)
+            if self._tag_store is not None and forgotten:
+                self._tag_store.clear(tagstore.TagStore.GRAPHICS, forgotten)
+        return changed
+
+    def watch(self, target_dir, output_dir, interval=1.0, **merge_options):
+        """Merge the graphics set into target_dir, and then merge again
+        every time the graphics source or target_dir changes, until
+        interrupted (by Ctrl+C, for example).
+
+        * interval is how many seconds to wait between looks for changes.
+        The trees are polled, so any platform will do.
+        * merge_options are passed on to merge(), along with target_dir and
+        output_dir.
+
+        Every look for changes stats every file, but reads none of them.
+        Only the files which have changed are parsed again, and only the
+        outputs which depend on them are written. Changes to the run config,
+        templates or ASCII conversions need a new session.
+        """
+        target_tree = rawtree.RawTreeIndex(target_dir, self._ignore_matcher)
+        written = self.merge(target_dir, output_dir,
+                             target_tree=target_tree, **merge_options)
+        print("Merged", len(written), "files. Watching for changes...")
+        while True:
+            time.sleep(interval)
+            new_target_tree = rawtree.RawTreeIndex(target_dir,
+                                                   self._ignore_matcher)
+            changed = (rawtree.changed_files(target_tree, new_target_tree) |
+                       self.refresh_graphics())
+            if not changed:
+                continue
+            userlog.info("Changed since the last merge: %s",
+                         ", ".join(sorted(changed)))
+            try:
+                written = self.merge(target_dir, output_dir,
+                                     target_tree=new_target_tree,
+                                     **merge_options)
+            except OSError:
+                # Most likely a file changed while it was being read; the
+                # next look will find it and try again.
+                userlog.warning("Could not finish merging; trying again " +
+                                "at the next change.")
+                userlog.warning(traceback.format_exc())
+                print("Could not finish merging; see the log for details.")
+                continue
+            target_tree = new_target_tree
+            print("Merged", len(written), "changed files.")
+
+    def _graphics_to_load(self, pairs, relpaths):
+        """Return the set of graphics files that go with the target files at
+        relpaths and haven't been parsed yet."""
+        return ({pairs[relpath] for relpath in relpaths} -
+                self._loaded_graphics)
+
+    def _bind_in_memory(self, target_tree, pairs, relpaths):
+        """Load the target raws at relpaths into memory, along with any of
+        their graphics files that haven't been loaded yet, and bind them.
+
+        * target_tree is the RawTreeIndex of the target.
+        * pairs maps target raw files to their graphics files, as returned
+        by rawtree.pair_rawfiles.
+
+        Returns the bound collection, as returned by
+        BoundNode.bind_graphics_to_targets.
+        """
+        graphics_relpaths = self._graphics_to_load(pairs, relpaths)
+        if graphics_relpaths:
+            for graphics_tree in self._graphics_trees:
+                self._graphics_tags_by_file = \
+                    graphics.TagNode.walk_rawfiles_into_tagnode_collection(
+                        graphics_tree, self._graphics_tags_by_file,
+                        jobs=self._jobs, relpaths=graphics_relpaths)
+            self._loaded_graphics |= graphics_relpaths
+        # Key the graphics by the target files they go with.
+        graphics_for_targets = {
+            relpath: self._graphics_tags_by_file[pairs[relpath]]
+            for relpath in relpaths
+            if pairs[relpath] in self._graphics_tags_by_file}
+
+        target_tags_by_file = self._parse_targets(target_tree,
+                                                  graphics_for_targets,
+                                                  relpaths)
+        return graphics.BoundNode.bind_graphics_to_targets(
+            graphics_for_targets, target_tags_by_file)
+
+    def _parse_targets(self, target_tree, graphics_for_targets, relpaths):
+        """Return the collection of the target raws at relpaths, as
+        returned by walk_rawfiles_into_tagnode_collection.
+
+        Files kept from the last merge into the same target are reused, so
+        long as they haven't changed since, and their graphics have no
+        top-level tags they weren't parsed for. The rest are parsed and kept
+        in their place.
+        """
+        if target_tree.directory != self._target_dir:
+            self._target_dir = target_tree.directory
+            self._parsed_targets = {}
+        for relpath in self._parsed_targets.keys() - target_tree.files.keys():
+            del self._parsed_targets[relpath]
+        to_parse = {}
+        for relpath in relpaths:
+            stat = target_tree.files[relpath].stat
+            stat = (stat.st_size, stat.st_mtime_ns)
+            wanted = frozenset(graphics_for_targets.get(relpath, ()))
+            parsed = self._parsed_targets.get(relpath)
+            if ((parsed is None or parsed.stat != stat or
+                 not wanted <= parsed.wanted)):
+                to_parse[relpath] = (stat, wanted)
+        if to_parse:
+            parsed_tags_by_file = \
+                graphics.TagNode.walk_rawfiles_into_tagnode_collection(
+                    target_tree, jobs=self._jobs,
+                    graphics_index=graphics_for_targets,
+                    relpaths=to_parse.keys())
+            for relpath, (stat, wanted) in to_parse.items():
+                self._parsed_targets[relpath] = _ParsedTarget(
+                    stat, wanted, parsed_tags_by_file.get(relpath))
+        userlog.info("%i target files parsed, %i kept from the last merge.",
+                     len(to_parse), len(relpaths) - len(to_parse))
+        # In walk order, as walk_rawfiles_into_tagnode_collection does.
+        return {relpath: self._parsed_targets[relpath].tops
+                for relpath in target_tree.relpaths(rawtree.RAW)
+                if relpath in relpaths and
+                self._parsed_targets[relpath].tops is not None}
+
+    def _bind_in_store(self, target_tree, pairs, relpaths):
+        """Load the target raws at relpaths into the tag store, in place of
+        the last merge's, along with any of their graphics files that aren't
+        in it yet.
+
+        The arguments are as for _bind_in_memory. Returns a StoreBindings,
+        which binds each file from the store as it's written.
+        """
+        tag_store = self._tag_store
+        graphics_relpaths = self._graphics_to_load(pairs, relpaths)
+        if graphics_relpaths:
+            for graphics_tree in self._graphics_trees:
+                tag_store.add_rawfiles(graphics_tree,
+                                       tagstore.TagStore.GRAPHICS,
+                                       jobs=self._jobs,
+                                       relpaths=graphics_relpaths)
+            self._loaded_graphics |= graphics_relpaths
+        graphics_index = tag_store.index(tagstore.TagStore.GRAPHICS)
+        tag_store.clear(tagstore.TagStore.TARGET)
+        tag_store.add_rawfiles(
+            target_tree, tagstore.TagStore.TARGET, jobs=self._jobs,
+            graphics_index={relpath: graphics_index[pairs[relpath]]
+                            for relpath in relpaths
+                            if pairs[relpath] in graphics_index},
+            relpaths=relpaths)
+        return tagstore.StoreBindings(tag_store, pairs)
+
+    def close(self):
+        """Release the session's tag store, if it has one."""
+        if self._tag_store is not None:
+            self._tag_store.close()
+            self._tag_store = None
@@ -0,0 +1,229 @@
+'''
+Created on Oct 18, 2026
+
+@author: Button
+'''
+
+from src.bamm.common import config, rawcache
+from src.bamm.graphics import graphics
+import collections.abc
+import sqlite3
+import threading
+import traceback
+
+userlog = config.userlog
+
+# Stored in the file's user_version, so a TagStore never empties a database
+# that isn't its own. It's "BAMM" in ASCII.
+_TAG_STORE_MARK = 0x42414D4D
+
+_TAG_STORE_SCHEMA = """
+PRAGMA journal_mode = OFF;
+PRAGMA synchronous = OFF;
+DROP TABLE IF EXISTS tags;
+CREATE TABLE tags (
+    id INTEGER PRIMARY KEY,
+    source INTEGER NOT NULL,
+    filename TEXT NOT NULL,
+    top TEXT NOT NULL,
+    object INTEGER NOT NULL,
+    parent INTEGER,
+    template INTEGER NOT NULL,
+    tag TEXT NOT NULL,
+    pattern TEXT
+);
+CREATE INDEX tags_by_file ON tags (source, filename);
+PRAGMA user_version = %i;
+""" % _TAG_STORE_MARK
+
+
+class TagStore():
+    """An on-disk stand-in for the TagNode collections returned by
+    walk_rawfiles_into_tagnode_collection, for raw sets too big to hold in
+    memory all at once.
+
+    Every graphics-relevant tag is a row in a single SQLite table, holding
+    its source (GRAPHICS or TARGET), its file's relative path, the top-level
+    tag and row of the object it's in, its parent's row, its template (as an
+    index into graphics._template_list()), the tag itself and its pattern.
+    TagNode trees are only built one file at a time, when they're asked for.
+
+    The store is scratch space: its table is emptied whenever a TagStore is
+    opened on it. The file is marked as a tag store in its user_version, and
+    a TagStore won't open a database with tables in it that doesn't carry the
+    mark. A MergeSession keeps one open across merges, loading each
+    graphics file into it once and replacing the target's tags each time.
+
+    Members:
+        * _connection is the connection to the SQLite file.
+        * _templates and _template_indexes translate between TemplateNodes
+        and their indexes in graphics._template_list().
+        * _next_id is the row id the next tag added will get.
+        * _lock serializes use of _connection, so files can be bound from
+        several threads at once.
+    """
+
+    GRAPHICS = 0
+    TARGET = 1
+
+    def __init__(self, path):
+        userlog.info("Opening tag store %s ...", path)
+        try:
+            self._connection = sqlite3.connect(path, check_same_thread=False)
+            mark, = self._connection.execute(
+                "PRAGMA user_version").fetchone()
+            tables, = self._connection.execute(
+                "SELECT count(*) FROM sqlite_master").fetchone()
+            if mark != _TAG_STORE_MARK and tables:
+                self._connection.close()
+                raise ValueError(path + " is a database, but not a tag " +
+                                 "store.")
+            self._connection.executescript(_TAG_STORE_SCHEMA)
+        except (sqlite3.Error, ValueError):
+            userlog.error("Could not open tag store %s . If it isn't a " +
+                          "tag store, please point tag_store somewhere else.",
+                          path)
+            userlog.error(traceback.format_exc())
+            raise
+        self._templates = graphics._template_list()
+        self._template_indexes = {node: ii for ii, node
+                                  in enumerate(self._templates)}
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def add_rawfiles(self, directory, source, jobs=1, graphics_index=None,
+                     relpaths=None):
+        """Load the graphics-relevant content of the raw files in directory
+        into the store.
+
+        * source is TagStore.GRAPHICS or TagStore.TARGET.
+
+        The other arguments are as for walk_rawfiles_into_tagnode_collection.
+        Only one file's tags are held in memory at a time.
+        """
+        try:
+            for rawfile, placements in graphics._walk_placements(
+                    directory, jobs, graphics_index, relpaths):
+                userlog.info("Storing graphics tags from %s...", rawfile)
+                base = self._next_id
+                rows = []
+                for template, tag, parent, pattern in placements:
+                    if isinstance(template, graphics.TemplateNode):
+                        template = self._template_indexes[template]
+                    row_id = base + len(rows)
+                    if parent is None:
+                        top, tag_object = tag, row_id
+                    else:
+                        top, tag_object = rows[parent][3], rows[parent][4]
+                        parent += base
+                    rows.append((row_id, source, rawfile, top, tag_object,
+                                 parent, template, tag, pattern))
+                self._connection.executemany(
+                    "INSERT INTO tags VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    rows)
+                self._connection.commit()
+                self._next_id += len(rows)
+        except:
+            userlog.error("Exception in loading raws.")
+            userlog.error(traceback.format_exc())
+            raise
+        if rawcache.raw_cache is not None:
+            userlog.info("Lexed-raw cache: %i hits, %i misses.",
+                         rawcache.raw_cache.hits, rawcache.raw_cache.misses)
+            rawcache.raw_cache.trim()
+
+    def clear(self, source, filenames=None):
+        """Remove the tags loaded from source, so other files can be loaded
+        in their place.
+
+        * filenames is an optional collection of the files to remove the
+        tags of. If it's None, every file's tags are removed.
+        """
+        with self._lock:
+            if filenames is None:
+                self._connection.execute("DELETE FROM tags WHERE source = ?",
+                                         (source,))
+            else:
+                self._connection.executemany(
+                    "DELETE FROM tags WHERE source = ? AND filename = ?",
+                    [(source, filename) for filename in filenames])
+            self._connection.commit()
+
+    def index(self, source):
+        """Return a dict mapping each file loaded from source to the set of
+        its top-level tags."""
+        to_return = {}
+        for filename, top in self._connection.execute(
+                "SELECT DISTINCT filename, top FROM tags WHERE source = ?",
+                (source,)):
+            to_return.setdefault(filename, set()).add(top)
+        return to_return
+
+    def filenames(self, source):
+        """Return the set of the files loaded from source."""
+        return {filename for filename, in self._connection.execute(
+            "SELECT DISTINCT filename FROM tags WHERE source = ?", (source,))}
+
+    def top_level_nodes(self, source, filename):
+        """Build the TagNode trees of the file filename (a relative path)
+        from source.
+
+        Returns the file's {tag:TagNode} dict, the same as its entry in a
+        collection returned by walk_rawfiles_into_tagnode_collection.
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT id, parent, template, tag, pattern FROM tags " +
+                "WHERE source = ? AND filename = ? ORDER BY id",
+                (source, filename)).fetchall()
+        nodes = {}
+        to_return = {}
+        for row_id, parent, template, tag, pattern in rows:
+            node = graphics.TagNode(
+                filename, self._templates[template], tag,
+                None if parent is None else nodes[parent], pattern)
+            nodes[row_id] = node
+            if parent is None:
+                to_return[node._tag] = node
+        return to_return
+
+    def close(self):
+        self._connection.close()
+
+
+class StoreBindings(collections.abc.Mapping):
+    """A read-only mapping of target files to {tag:BoundNode} dicts, the same
+    as the dict returned by BoundNode.bind_graphics_to_targets, but backed by
+    a TagStore.
+
+    A file is bound from the store each time it is looked up, and isn't
+    kept, so only one file's trees need to be in memory at a time.
+    """
+
+    def __init__(self, tag_store, pairs):
+        """* pairs maps the target files to the graphics files that go with
+        them, as returned by rawtree.pair_rawfiles."""
+        self._tag_store = tag_store
+        graphics_files = tag_store.filenames(TagStore.GRAPHICS)
+        self._pairs = {filename: pairs[filename] for filename
+                       in tag_store.filenames(TagStore.TARGET)
+                       if pairs.get(filename) in graphics_files}
+        self._filenames = self._pairs.keys()
+
+    def __getitem__(self, filename):
+        if filename not in self._filenames:
+            raise KeyError(filename)
+        return graphics.BoundNode._bind_file(
+            filename,
+            self._tag_store.top_level_nodes(TagStore.GRAPHICS,
+                                            self._pairs[filename]),
+            self._tag_store.top_level_nodes(TagStore.TARGET, filename))
+
+    def __contains__(self, filename):
+        return filename in self._filenames
+
+    def __iter__(self):
+        return iter(sorted(self._filenames))
+
+    def __len__(self):
+        return len(self._filenames)
@@ -0,0 +1,20 @@
+'''
+Created on Oct 18, 2026
+
+@author: Button
+
+Merges with the options in run.config, then keeps watching the graphics
+source and target, and merges again whenever a file in them changes. Run it
+as
+
+    python watch_default.py [seconds between looks]
+
+The default is to look once a second. Press Ctrl+C to stop.
+'''
+import sys
+from src.bamm.graphics import execution
+
+# Worker processes (see the jobs property) import this module again, so only
+# run when it's executed directly.
+if __name__ == '__main__':
+    execution.default_watch(*(float(arg) for arg in sys.argv[1:2]))